@@ -0,0 +1,107 @@
+import numpy as np
+
+# my modules
+from ray import Ray
+from utils import quantize
+
+# fraction of the step that the gradient predicts reaches an opaque value
+STEP_SAFETY = 0.5
+
+class AdaptiveRay(Ray):
+    """
+    Ray whose step length adapts to the transfer function: steps double through
+    transparent stretches, but stay short enough that the gradient does not
+    predict reaching an opaque value, and drop to the minimum at features,
+    samples with opacity or steps whose value range spans opaque LUT entries
+    a long step landing on a feature is retried at half the length until it
+    no longer does, or is at the minimum
+    steps are in multiples of plane_sep, between context.adaptive_steps (min, max)
+    and every sample's opacity is corrected for the step that led to it
+    sample_idx is fractional, in units of plane_sep along the ray
+    """
+    def __init__(self):
+        super().__init__()
+        self.samples_evaluated = 0 # total over all rays marched
+
+    def start(self, idx_horizontal, idx_vertical, convolution, context):
+        super().start(idx_horizontal, idx_vertical, convolution, context)
+        self.step_taken = context.adaptive_steps[0] # step that led to this sample
+        # last blended sample and its LUT index, to back up to
+        self.sample_prev = None
+        self.lut_prev = None
+        # closing in on a feature, steps stop doubling until it is reached
+        self.refining = False
+
+    def step(self, convolution, context):
+        """
+        rndProbeRgbaLit with an adaptive step
+        returns a boolean, keepgoing
+        """
+        camera = context.camera
+        step_min, step_max = context.adaptive_steps
+        sample_idx = self.sample_idx
+        # past the valid box, nothing left to blend
+        if sample_idx > self.sample_last:
+            return False
+        pos_view_z = self.pos_view_init[2, 0] + sample_idx * self.step_view[2, 0]
+        # stop when -p_n > fcv
+        if -pos_view_z > camera.far_clip_view:
+            return False # no need to keep going
+
+        pos_index = self.pos_index_init + sample_idx * self.step_index
+        if context.empty_space is not None and \
+        self.skip_transparent(sample_idx, pos_index, context):
+            # resume with plane_sep steps on the far side of the skipped stretch
+            self.step_taken = min(max(1, step_min), step_max)
+            self.sample_prev = None
+            return True
+        self.samples_evaluated += 1
+        convolution.evaluate_index(pos_index[0], pos_index[1], pos_index[2], context,
+        gradient=False)
+
+        if not convolution.inside:
+            self.sample_idx = sample_idx + step_min
+            self.step_taken = step_min
+            self.sample_prev = None
+            return True
+
+        transfer_func = context.transfer_func
+        lut_idx = quantize(transfer_func.vmin, convolution.value,
+        transfer_func.vmax, transfer_func.len)
+        # a feature is any opacity at the sample or between it and the last one
+        lut_lo = lut_hi = lut_idx
+        if self.sample_prev is not None:
+            lut_lo, lut_hi = min(lut_idx, self.lut_prev), max(lut_idx, self.lut_prev)
+        opaque_before = transfer_func.opaque_before
+        feature = opaque_before[lut_hi + 1] > opaque_before[lut_lo]
+        if feature and self.step_taken > step_min and self.sample_prev is not None:
+            # retry a shorter step from the last blended sample
+            self.step_taken = max(self.step_taken / 2, step_min)
+            self.sample_idx = self.sample_prev + self.step_taken
+            self.refining = True
+            return True
+
+        self.result_curr = self.shade(convolution, lut_idx, sample_idx, pos_view_z,
+        self.step_taken * self.step_view_len, context)
+        keepgoing = self.blend(context)
+
+        if feature:
+            step_next = step_min
+            self.refining = False
+        elif self.refining:
+            step_next = self.step_taken
+        else:
+            step_next = min(2 * self.step_taken, step_max)
+            # value distance to the nearest opaque entry, over the rate of change
+            value = convolution.value
+            gap = min(transfer_func.opaque_above[lut_idx] - value,
+            value - transfer_func.opaque_below[lut_idx])
+            convolution.evaluate_gradient(context)
+            rate = np.linalg.norm(convolution.gradient) * self.step_view_len
+            if rate * step_next > STEP_SAFETY * gap:
+                step_next = max(STEP_SAFETY * gap / rate, step_min)
+        self.sample_prev = sample_idx
+        self.lut_prev = lut_idx
+        self.sample_idx = sample_idx + step_next
+        self.step_taken = step_next
+        return keepgoing
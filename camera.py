@@ -1,10 +1,15 @@
 import numpy as np
 
 class Camera():
-    def __init__(self, fr, at, up, near_clip, far_clip, field_of_view, img_plane_size, ortho):
+    def __init__(self, fr, at, up, near_clip, far_clip, field_of_view, img_plane_size, ortho,
+    dtype=np.float64):
         """
         field_of_view: degrees
+        dtype: floating-point type of the vectors, matrices and scalars below
         """
+        fr = np.asarray(fr, dtype=dtype)
+        at = np.asarray(at, dtype=dtype)
+        up = np.asarray(up, dtype=dtype)
         self.fr = fr
         self.at = at
         self.up = up
@@ -30,13 +35,13 @@ class Camera():
         mat = np.hstack([
             self.u, self.v, self.n, self.fr
         ])
-        self.VtoW = np.append(mat, [[0, 0, 0, 1]], axis=0)
+        self.VtoW = np.append(mat, np.array([[0, 0, 0, 1]], dtype=dtype), axis=0)
         # ncv, fcv: near_clip_view, far_clip_view
-        self.near_clip_view = self.near_clip + self.dist
-        self.far_clip_view = self.far_clip + self.dist
+        self.near_clip_view = dtype(self.near_clip + self.dist)
+        self.far_clip_view = dtype(self.far_clip + self.dist)
         # height and width of the image plane, different from sizes
         # hght = 2d tan(FOV / 2), FOV must be in radians
         radians = np.radians(self.field_of_view)
-        self.img_plane_height = 2 * self.dist * np.tan(radians / 2)
+        self.img_plane_height = dtype(2 * self.dist * np.tan(radians / 2))
         # wdth = ar hght
-        self.img_plane_width = self.aspect_ratio * self.img_plane_height
+        self.img_plane_width = dtype(self.aspect_ratio * self.img_plane_height)
@@ -0,0 +1,76 @@
+# kernel.c
+import numpy as np
+
+class CatmullRomKernel():
+    """
+    interpolating cubic, support 4
+    """
+    def __init__(self):
+        self.name = 'ctmr'
+        self.support = 4
+
+    def evaluate(self, xx):
+        ret = 0
+        x = np.fabs(xx)
+        if x < 1:
+            ret = 1 + x * x * (-5 / 2 + x * (3 / 2))
+        elif x < 2:
+            ret = 2 + x * (-4 + x * (5 / 2 - x / 2))
+        return ret
+
+    def apply(self, xs):
+        """
+        vectorized version of evaluate, xs is a vector
+        """
+        ret = np.zeros(xs.shape)
+        x = np.fabs(xs)
+        ret = np.where(x < 1, 1 + x * x * (-5 / 2 + x * (3 / 2)), ret)
+        ret = np.where((x >= 1) & (x < 2), 2 + x * (-4 + x * (5 / 2 - x / 2)), ret)
+        return ret
+
+    def evaluate_derivative(self, xx):
+        """
+        derivative of Catmull-Rom kernel
+        """
+        ret = 0
+        x = np.fabs(xx)
+        if x < 1:
+            ret = x * (-5 + x * (9 / 2))
+        elif x < 2:
+            ret = -4 + x * (5 - x * (3 / 2))
+        if xx < 0:
+            return -ret
+        else:
+            return ret
+
+    def apply_derivative(self, xs):
+        ret = np.zeros(xs.shape)
+        x = np.fabs(xs)
+        ret = np.where(x < 1, x * (-5 + x * (9 / 2)), ret)
+        ret = np.where((x >= 1) & (x < 2), -4 + x * (5 - x * (3 / 2)), ret)
+        ret = np.where(xs < 0, -ret, ret)
+        return ret
+
+    def weights(self, alphas):
+        """
+        weights and derivatives at all support points in one call
+        alphas: floating-point array of fractional offsets in [0, 1), any shape
+        the results have the same dtype as alphas
+        returns (weights, derivatives), each of shape alphas.shape + (4,)
+        entry i holds apply(alpha - (i - 1)) resp. apply_derivative(alpha - (i - 1))
+        """
+        t = np.asarray(alphas)
+        t2 = t * t
+        weights = np.stack([
+            t * (-1 + t * (2 - t)) / 2,
+            (2 + t2 * (-5 + 3 * t)) / 2,
+            t * (1 + t * (4 - 3 * t)) / 2,
+            t2 * (t - 1) / 2,
+        ], axis=-1)
+        derivatives = np.stack([
+            (-1 + t * (4 - 3 * t)) / 2,
+            t * (-10 + 9 * t) / 2,
+            (1 + t * (8 - 9 * t)) / 2,
+            t * (-2 + 3 * t) / 2,
+        ], axis=-1)
+        return weights, derivatives
@@ -1,18 +1,139 @@
 import math
+from collections import OrderedDict
+
 import numpy as np
 
+# my modules
+from prefiltered_sampler import trilinear, trilinear_many
+
+def contract(neighborhood, kx, ky, kz, dx, dy, dz):
+    """
+    tensor-product convolution of separable kernels
+    neighborhood: (N, support, support, support) blocks indexed [n, x, y, z]
+    kx, ky, kz: (N, support) kernel weights along each axis
+    dx, dy, dz: (N, support) kernel derivative weights along each axis
+    returns values (N,) and index-space gradients (N, 3)
+    contracts one axis at a time (z, then y, then x) so that value and
+    gradient share the partial sums instead of four full 3-D passes
+    """
+    # contract z: (N, x, y)
+    vz = np.einsum('nijk,nk->nij', neighborhood, kz)
+    dvz = np.einsum('nijk,nk->nij', neighborhood, dz)
+    # contract y: (N, x)
+    vzy = np.einsum('nij,nj->ni', vz, ky)
+    vz_dy = np.einsum('nij,nj->ni', vz, dy)
+    dvz_y = np.einsum('nij,nj->ni', dvz, ky)
+    # contract x: (N,)
+    value = np.einsum('ni,ni->n', vzy, kx)
+    gradient_index = np.stack([
+        np.einsum('ni,ni->n', vzy, dx),
+        np.einsum('ni,ni->n', vz_dy, kx),
+        np.einsum('ni,ni->n', dvz_y, kx),
+    ], axis=1)
+    return value, gradient_index
+
+def contract_value(neighborhood, kx, ky, kz):
+    """
+    value-only version of contract, returns values (N,)
+    """
+    vz = np.einsum('nijk,nk->nij', neighborhood, kz)
+    vzy = np.einsum('nij,nj->ni', vz, ky)
+    return np.einsum('ni,ni->n', vzy, kx)
+
+def volume_data(volume):
+    """
+    returns the array to gather from and its ghost-cell offset
+    """
+    if getattr(volume, 'padded', None) is not None:
+        return volume.padded, volume.pad
+    return volume.data, 0
+
+def dequantize(neighborhood, volume, dtype, index=None):
+    """
+    converts a gathered neighborhood of an integer volume to dtype
+    applying value = stored * volume.scale + volume.offset
+    float volumes pass through unchanged
+    volumes quantized per brick need index, a tuple of three integer arrays
+    broadcasting to the spatial shape of neighborhood, holding the (unpadded)
+    x, y, z indices of the gathered voxels
+    """
+    if volume.scale is None:
+        return neighborhood
+    scale, offset = volume.scale, volume.offset
+    if volume.brick_size is not None:
+        # ghost cells replicate the edge, so they belong to the edge bricks
+        brick = tuple(np.clip(idx, 0, n - 1) // volume.brick_size
+        for idx, n in zip(index, volume.data.shape[-3:]))
+        scale, offset = scale[brick], offset[brick]
+    return neighborhood.astype(dtype) * dtype(scale) + dtype(offset)
+
 class Convolution():
+    def __init__(self, cache_size=0):
+        """
+        cache_size: max number of gathered neighborhoods kept in an LRU cache
+        keyed by the base index (xn, yn, zn), 0 disables the cache
+        one Convolution per worker, so the cache needs no locking
+        """
+        self.cache_size = cache_size
+        self.block_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
-    def evaluate(self, x_world, y_world, z_world, context):
-        # fill in these two outputs
-        self.value = None
-        self.gradient = None # world-space gradients
+    def gather(self, xn, yn, zn, context):
+        """
+        returns the (support, support, support) neighborhood around base index
+        (xn, yn, zn), indexed [x, y, z], which must lie inside the volume
+        multi-channel volumes give (num_channels, support, support, support)
+        """
+        key = (xn, yn, zn)
+        if self.cache_size:
+            neighborhood = self.block_cache.get(key)
+            if neighborhood is not None:
+                self.cache_hits += 1
+                self.block_cache.move_to_end(key)
+                return neighborhood
 
-        size_x, size_y, size_z = context.volume.data.shape
+        idx_start = context.idx_start
+        idx_end = context.idx_end
+        data, pad = volume_data(context.volume)
+        neighborhood = data[...,
+            pad + xn + idx_start:pad + xn + idx_end + 1,
+            pad + yn + idx_start:pad + yn + idx_end + 1,
+            pad + zn + idx_start:pad + zn + idx_end + 1]
+        index = None
+        if context.volume.brick_size is not None:
+            offsets = np.arange(idx_start, idx_end + 1)
+            index = np.ix_(xn + offsets, yn + offsets, zn + offsets)
+        neighborhood = dequantize(neighborhood, context.volume, context.dtype, index)
+
+        if self.cache_size:
+            self.cache_misses += 1
+            # contiguous copy, so the cache does not pin strided views
+            self.block_cache[key] = np.ascontiguousarray(neighborhood)
+            if len(self.block_cache) > self.cache_size:
+                self.block_cache.popitem(last=False) # least recently used
+        return neighborhood
+
+    def evaluate(self, x_world, y_world, z_world, context, gradient=True):
+        """
+        gradient: if False, only self.value is computed and self.gradient stays
+        None until evaluate_gradient is called for this same sample
+        """
         pos_world = np.array([[x_world, y_world, z_world, 1]]).T # column vec
         self.pos_index = context.WtoI @ pos_world
         # the last entry of the len-4 vec is unused
         x_index, y_index, z_index, _ = self.pos_index.squeeze()
+        self.evaluate_index(x_index, y_index, z_index, context, gradient)
+
+    def evaluate_index(self, x_index, y_index, z_index, context, gradient=True):
+        """
+        same as evaluate, but takes an index-space position
+        """
+        # fill in these two outputs
+        self.value = None
+        self.gradient = None # world-space gradients
+        # kept for the central-difference gradient
+        self.x_index, self.y_index, self.z_index = x_index, y_index, z_index
 
         kernel = context.kernel
         # compute convolution
@@ -28,71 +149,169 @@ class Convolution():
         yalpha = y_index - yn
         zalpha = z_index - zn
 
-        # points at which to evaluate the convolution
+        # the whole support must lie in the volume on every axis
+        lo_x, lo_y, lo_z = context.valid_lo
+        hi_x, hi_y, hi_z = context.valid_hi
+        self.inside = lo_x <= xn <= hi_x and lo_y <= yn <= hi_y and lo_z <= zn <= hi_z
+        if not self.inside: # convo cannot be evaluated
+            return
+
+        # constant support: the weights sum to 1 and the kernel gradient vanishes
+        self.uniform = context.uniform is not None and \
+        context.uniform[xn - lo_x, yn - lo_y, zn - lo_z]
+        if self.uniform:
+            self.value = context.dtype(dequantize(
+            context.volume.data[xn, yn, zn], context.volume, context.dtype,
+            (xn, yn, zn)))
+            if gradient:
+                self.evaluate_gradient(context)
+            return
+
+        # (3, support) weights and derivatives at alpha - idx for idx in support
+        kern_cache, kern_deriv_cache = kernel.weights(
+        np.array([xalpha, yalpha, zalpha], dtype=context.dtype))
+
+        # gather the neighborhood as one block, indexed [x, y, z]
+        neighborhood = self.gather(xn, yn, zn, context)
+        # kept for evaluate_gradient
+        # channels go along the batch axis of contract and share the weights,
+        # so multi-channel values are (num_channels,) and gradients (3, num_channels)
+        num_channels = context.volume.num_channels
+        if num_channels is None:
+            self.neighborhood = neighborhood[np.newaxis]
+            num_channels = 1
+        else:
+            self.neighborhood = neighborhood
+        support = kern_cache.shape[1]
+        self.kern_cache = np.broadcast_to(kern_cache[:, np.newaxis],
+        (3, num_channels, support))
+        self.kern_deriv_cache = np.broadcast_to(kern_deriv_cache[:, np.newaxis],
+        (3, num_channels, support))
+        squeeze = context.volume.num_channels is None
+        if not gradient or context.gradient_method == 'cdiff':
+            value = contract_value(self.neighborhood, *self.kern_cache)
+            self.value = value[0] if squeeze else value
+            if gradient:
+                self.evaluate_gradient(context)
+            return
+        value, gradient_index = contract(self.neighborhood,
+        *self.kern_cache, *self.kern_deriv_cache)
+        self.value = value[0] if squeeze else value
+        self.gradient = context.gradient_ItoW @ gradient_index.T
+        # no return value
+
+    def evaluate_gradient(self, context):
+        """
+        second phase of evaluate(..., gradient=False)
+        fills in self.gradient for the last evaluated sample, which must be inside
+        """
+        # the central differences reach one voxel past the kernel support, so
+        # only the kernel gradient is known to vanish over a uniform support
+        if self.uniform and context.gradient_method != 'cdiff':
+            self.gradient = np.zeros((3, 1), dtype=context.dtype)
+            return
+        if context.gradient_method == 'cdiff':
+            gradient_index = trilinear(context.gradient_volume,
+            self.x_index, self.y_index, self.z_index, context.dtype)
+            self.gradient = context.gradient_ItoW @ gradient_index[:, np.newaxis]
+            return
+        _, gradient_index = contract(self.neighborhood,
+        *self.kern_cache, *self.kern_deriv_cache)
+        self.gradient = context.gradient_ItoW @ gradient_index.T
+
+    def evaluate_many(self, pos_world, context, gradient=True):
+        """
+        batched version of evaluate, scalar volumes only
+        pos_world: (N, 3) array of world-space positions
+        returns (values, gradients, inside) of shapes (N,), (N, 3), (N,)
+        values and gradients are NaN where inside is False
+        gradients is None if gradient is False
+        """
+        pos_world = np.asarray(pos_world, dtype=context.dtype).reshape(-1, 3)
+        # row vectors, so multiply by the transpose
+        pos_index = pos_world @ context.WtoI[:3, :3].T + context.WtoI[:3, 3]
+        return self.evaluate_many_index(pos_index, context, gradient)
+
+    def evaluate_many_index(self, pos_index, context, gradient=True):
+        """
+        same as evaluate_many, but takes (N, 3) index-space positions
+        """
+        pos_index = np.asarray(pos_index, dtype=context.dtype).reshape(-1, 3)
+        num = pos_index.shape[0]
+
+        kernel = context.kernel
+        if kernel.support & 1: # odd support
+            base = np.floor(pos_index + 0.5)
+        else:
+            base = np.floor(pos_index)
+        alpha = pos_index - base
+        base = base.astype(int)
+
         idx_start = context.idx_start
         idx_end = context.idx_end
         convo_vals = np.arange(idx_start, idx_end + 1)
 
-        kern_cache_x = kernel.apply(xalpha - convo_vals)
-        kern_cache_y = kernel.apply(yalpha - convo_vals)
-        kern_cache_z = kernel.apply(zalpha - convo_vals)
-
-        kern_deriv_cache_x = kernel.apply_derivative(xalpha - convo_vals)
-        kern_deriv_cache_y = kernel.apply_derivative(yalpha - convo_vals)
-        kern_deriv_cache_z = kernel.apply_derivative(zalpha - convo_vals)
-
-        convo_result = 0 # assign to self.value if convo is valid
-        # column vector to accumulate gradient during convo
-        gradient_index = np.zeros((3, 1))
-
-        # the main convo loop
-        # index into context.volume[vol_idx_x, vol_idx_y, vol_idx_z]
-        # outermost loop, slow axis
-        self.inside = True # set to False if convo cannot be evaluated
-        for zi in range(idx_start, idx_end + 1):
-            vol_idx_z = zn + zi
-            if not self.inside or not 0 <= vol_idx_z < size_z:
-                self.inside = False
-                break
-            # look up convo result in cache
-            kern_res_z = kern_cache_z[zi - idx_start]
-            kern_deriv_res_z = kern_deriv_cache_z[zi - idx_start]
-
-            # inner loop, faster axis
-            for yi in range(idx_start, idx_end + 1):
-                vol_idx_y = yn + yi
-                if not self.inside or not 0 <= vol_idx_y < size_y:
-                    self.inside = False
-                    break
-                # look up convo result in cache
-                kern_res_y = kern_cache_y[yi - idx_start]
-                kern_deriv_res_y = kern_deriv_cache_y[yi - idx_start]
-
-                # innermost loop, fastest axis
-                for xi in range(idx_start, idx_end + 1):
-                    vol_idx_x = xn + xi
-                    if not self.inside or not 0 <= vol_idx_x < size_x:
-                        self.inside = False
-                        break
-                    # look up convo result in cache
-                    kern_res_x = kern_cache_x[xi - idx_start]
-                    kern_deriv_res_x = kern_deriv_cache_x[xi - idx_start]
-
-                    # compute convolution
-                    val = context.volume.data[vol_idx_x, vol_idx_y, vol_idx_z]
-                    # accumulate convo result
-                    convo_result += val * kern_res_x * kern_res_y * kern_res_z
-                    # accumulate gradients
-                    gradient_index[0] += val * \
-                    kern_deriv_res_x * kern_res_y * kern_res_z
-                    gradient_index[1] += val * \
-                    kern_res_x * kern_deriv_res_y * kern_res_z
-                    gradient_index[2] += val * \
-                    kern_res_x * kern_res_y * kern_deriv_res_z
-                    # end innermost loop
-                # end inner loop
-            # end outer loop
-        if self.inside: # convo is valid
-            self.value = convo_result
-            self.gradient = context.gradient_ItoW @ gradient_index
-        # no return value
+        # (N, 3, support), one row of kernel weights per sample per axis
+        kern_cache, kern_deriv_cache = kernel.weights(alpha)
+
+        # the whole support must lie in the volume on every axis
+        inside = np.all((context.valid_lo <= base) & (base <= context.valid_hi), axis=1)
+
+        values = np.full(num, np.nan, dtype=context.dtype)
+        gradients = np.full((num, 3), np.nan, dtype=context.dtype) if gradient else None
+        if not inside.any():
+            return values, gradients, inside
+
+        # samples with constant support take the voxel value and, for kernel
+        # gradients, a zero gradient
+        convolved = inside
+        if context.uniform is not None:
+            uniform = np.zeros(num, dtype=bool)
+            cell = base[inside] - context.valid_lo
+            uniform[inside] = context.uniform[cell[:, 0], cell[:, 1], cell[:, 2]]
+            cell = base[uniform]
+            values[uniform] = dequantize(context.volume.data[cell[:, 0], cell[:, 1], cell[:, 2]],
+            context.volume, context.dtype, tuple(cell.T))
+            if gradient and context.gradient_method == 'cdiff':
+                # the stencil reaches past the support, see evaluate_gradient
+                gradient_index = trilinear_many(context.gradient_volume, pos_index[uniform])
+                gradients[uniform] = gradient_index @ context.gradient_ItoW.T
+            elif gradient:
+                gradients[uniform] = 0
+            convolved = inside & ~uniform
+            if not convolved.any():
+                return values, gradients, inside
+
+        data, pad = volume_data(context.volume)
+        if pad:
+            # ghost cells keep every clipped gather in bounds, so gather all
+            # samples and mask the outside ones afterwards
+            base = np.clip(base, context.valid_lo - pad, context.valid_hi + pad)
+            sel = slice(None)
+        else:
+            sel = convolved
+        # (num_sel, 3, support) volume indices of the neighborhood
+        vol_idx = base[sel][:, :, np.newaxis] + convo_vals + pad
+        index = (vol_idx[:, 0, :, np.newaxis, np.newaxis],
+            vol_idx[:, 1, np.newaxis, :, np.newaxis],
+            vol_idx[:, 2, np.newaxis, np.newaxis, :])
+        neighborhood = data[index]
+        neighborhood = dequantize(neighborhood, context.volume, context.dtype,
+        tuple(idx - pad for idx in index))
+        kx, ky, kz = (kern_cache[sel, i] for i in range(3))
+        dx, dy, dz = (kern_deriv_cache[sel, i] for i in range(3))
+
+        if not gradient or context.gradient_method == 'cdiff':
+            value = contract_value(neighborhood, kx, ky, kz)
+            values[convolved] = value[convolved] if pad else value
+            if gradient:
+                gradient_index = trilinear_many(context.gradient_volume, pos_index[convolved])
+                gradients[convolved] = gradient_index @ context.gradient_ItoW.T
+            return values, gradients, inside
+        value, gradient_index = contract(neighborhood, kx, ky, kz, dx, dy, dz)
+        if pad:
+            value = value[convolved]
+            gradient_index = gradient_index[convolved]
+        values[convolved] = value
+        gradients[convolved] = gradient_index @ context.gradient_ItoW.T
+        return values, gradients, inside
@@ -3,6 +3,7 @@ import numpy as np
 
 class CubicBsplineKernel():
     def __init__(self):
+        self.name = 'bspln3'
         self.support = 4
 
     def evaluate(self, xx):
@@ -52,3 +53,29 @@ class CubicBsplineKernel():
         -1 / 2 + x_minus_one * (1 - x_minus_one / 2), ret)
         ret = np.where(xs < 0, -ret, ret)
         return ret
+
+    def weights(self, alphas):
+        """
+        weights and derivatives at all support points in one call
+        alphas: floating-point array of fractional offsets in [0, 1), any shape
+        the results have the same dtype as alphas
+        returns (weights, derivatives), each of shape alphas.shape + (4,)
+        entry i holds apply(alpha - (i - 1)) resp. apply_derivative(alpha - (i - 1))
+        """
+        t = np.asarray(alphas)
+        s = 1 - t
+        t2 = t * t
+        s2 = s * s
+        weights = np.stack([
+            s2 * s / 6,
+            2 / 3 + t2 * (-1 + t / 2),
+            2 / 3 + s2 * (-1 + s / 2),
+            t2 * t / 6,
+        ], axis=-1)
+        derivatives = np.stack([
+            -s2 / 2,
+            t * (-2 + t * (3 / 2)),
+            s * (2 - s * (3 / 2)),
+            t2 / 2,
+        ], axis=-1)
+        return weights, derivatives
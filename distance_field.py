@@ -0,0 +1,89 @@
+import numpy as np
+
+# my modules
+from prefiltered_sampler import volume_key
+from macrocell_grid import samples_in_box
+
+# distance maps by (volume, kernel, brick size, LUT path), the transform is the
+# slow part of a -dfield setup and precision_deviation repeats that setup
+# in float64 within the same run
+distance_cache = {}
+
+def min_filter_plane(plane):
+    """
+    min over the 3x3 neighborhood of every cell of a 2-D array
+    """
+    rows = plane.copy()
+    np.minimum(rows[1:], plane[:-1], out=rows[1:])
+    np.minimum(rows[:-1], plane[1:], out=rows[:-1])
+    out = rows.copy()
+    np.minimum(out[:, 1:], rows[:, :-1], out=out[:, 1:])
+    np.minimum(out[:, :-1], rows[:, 1:], out=out[:, :-1])
+    return out
+
+def chebyshev_distance(occupied):
+    """
+    Chebyshev distance in cells from every cell to the nearest occupied one,
+    max(occupied.shape) where nothing is occupied
+    the nearest cell is reached by a path of one step per cell along the axis
+    of the largest offset and at most one along the others, so sweeping the
+    planes across each axis both ways, each plane taking the 3x3 min of the
+    plane before plus one, is exact and linear in the number of cells
+    """
+    far = max(occupied.shape)
+    # far + 1 must fit, the narrowest type keeps the sweeps fast
+    dtype = np.int16 if far < np.iinfo(np.int16).max else int
+    distance = np.where(occupied, 0, far).astype(dtype)
+    for axis in range(3):
+        planes = np.moveaxis(distance, axis, 0) # view, updated in place
+        num = planes.shape[0]
+        for step in (1, -1): # forward, then backward
+            order = range(1, num) if step > 0 else range(num - 2, -1, -1)
+            for i in order:
+                np.minimum(planes[i], min_filter_plane(planes[i - step]) + 1,
+                out=planes[i])
+    return distance
+
+def distance_field(macrocells, volume, kernel, transfer_func):
+    """
+    returns the DistanceField of macrocells classified for transfer_func,
+    cached per volume and transfer function
+    """
+    key = volume_key(volume)
+    if key is not None and getattr(transfer_func, 'fpath', None) is not None:
+        key += (kernel.name, macrocells.brick_size, transfer_func.fpath)
+        if key not in distance_cache:
+            distance_cache[key] = chebyshev_distance(~macrocells.transparent)
+        distance = distance_cache[key]
+    else:
+        distance = chebyshev_distance(~macrocells.transparent)
+    return DistanceField(macrocells, distance)
+
+class DistanceField():
+    """
+    Chebyshev distance, in bricks of the macrocell grid, from every brick to
+    the nearest one that is not transparent, a brick size of 1 gives
+    voxel granularity
+    all bricks within distance - 1 of a transparent brick are transparent too,
+    so a ray can leap across that whole box at once
+    """
+    def __init__(self, macrocells, distance):
+        self.macrocells = macrocells
+        self.distance = distance
+
+    def skippable_samples(self, pos_index, step_index):
+        """
+        returns how many samples pos_index + j * step_index, j = 0, 1, ...
+        lie in the transparent box around the brick of pos_index,
+        0 if its brick is not transparent or pos_index is outside the valid box
+        """
+        macrocells = self.macrocells
+        brick = macrocells.brick_of(pos_index)
+        if brick is None:
+            return 0
+        reach = self.distance[brick] - 1
+        if reach < 0:
+            return 0
+        base_lo, base_hi = macrocells.brick_box(np.subtract(brick, reach),
+        np.add(brick, reach))
+        return samples_in_box(pos_index, step_index, base_lo, base_hi, macrocells.shift)
@@ -3,6 +3,7 @@ import sys
 sys.path.append('python-packages') # pip installed modules
 
 import argparse
+import time
 from types import SimpleNamespace
 
 import numpy as np
@@ -14,34 +15,95 @@ import threading
 from concurrent.futures import ThreadPoolExecutor
 
 # my modules
-from utils import construct_context
-from convolution import Convolution
+from utils import construct_context, construct_sampler, kernel_registry
 from ray import Ray
+from multi_channel_ray import MultiChannelRay
+from adaptive_ray import AdaptiveRay
+from preintegrated_ray import PreintegratedRay, PreintegratedAdaptiveRay
+from ray_packet import RayPacket
+from ortho_slice_engine import OrthoSliceEngine
+
+# number of distinct pixels re-rendered in float64 to estimate the float32
+# deviation, a sample, so it can miss the pixel that deviates most
+PRECISION_CHECK_PIXELS = 256
 
 # globals
 global_context = None
 global_img_out = None
 global_pbar = None
 global_row, global_col = 0, 0
+global_tiles = None # pixel tiles left for RayPacket workers
 global_mutex = threading.Lock()
 
 def main():
     params_dict = parse_args() # using argparse.ArgumentParser
 
     # initialize those shared among threads
-    global global_context, global_img_out, global_pbar
+    global global_context, global_img_out, global_pbar, global_tiles
 
     global_context = construct_context(params_dict)
+    if params_dict['kernel_table_res']:
+        print('tabulated kernel max error: {:.3g} (derivative {:.3g})'.format(
+        global_context.kernel.max_error, global_context.kernel.max_error_derivative))
+    if global_context.volume.brick_size is not None:
+        print('quantized to {} in {}^3 bricks: max error {:.3g}, rms error {:.3g}'.format(
+        global_context.volume.data.dtype, global_context.volume.brick_size,
+        *global_context.volume.quantize_error))
+    if global_context.macrocells is not None:
+        transparent = global_context.macrocells.transparent
+        print('macrocells: {} of {} transparent'.format(
+        np.count_nonzero(transparent), transparent.size))
     num_rows, num_cols = global_context.camera.img_plane_size
-    global_img_out = np.empty((4, num_rows, num_cols)) # 4 for RGBA
+    # 4 for RGBA, with a leading channel axis for multi-channel volumes
+    num_channels = global_context.volume.num_channels
+    shape = (4, num_rows, num_cols) if num_channels is None else \
+    (num_channels, 4, num_rows, num_cols)
+    global_img_out = np.empty(shape, dtype=global_context.dtype)
+
+    convolutions = []
+    rays = [] # or the slice engine, for the early ray termination report
+    use_slices = params_dict['ortho_slices'] and global_context.sampler == 'convo' and \
+    num_channels is None and global_context.adaptive_steps is None and \
+    global_context.preintegrated is None and not global_context.packet_size and \
+    OrthoSliceEngine.aligned_axes(global_context) is not None
+
+    time_start = time.perf_counter()
+    if use_slices: # axis-aligned orthographic, whole sample planes at once
+        engine = OrthoSliceEngine(global_context)
+        global_img_out[:] = engine.render(global_context)
+        rays.append(engine)
+
+    elif global_context.packet_size: # tiles of rays marched together
+        global_tiles = pixel_tiles(num_rows, num_cols, global_context.packet_size)
+        global_pbar = tqdm(total=len(global_tiles)) # total num of tiles
+        thread_args = []
+        for tid in range(max(global_context.num_threads, 1)):
+            targ = SimpleNamespace()
+            targ.tid = tid
+            # private
+            targ.ray = RayPacket()
+            targ.convolution = construct_sampler(global_context)
+            convolutions.append(targ.convolution)
+            rays.append(targ.ray)
+            thread_args.append(targ)
+
+        if len(thread_args) == 1:
+            packet_thread_func(thread_args[0])
+        else:
+            with ThreadPoolExecutor(max_workers=len(thread_args)) as executor:
+                executor.map(packet_thread_func, thread_args)
+
+        global_pbar.close()
 
-    if not global_context.num_threads: # 0 or unspecified
-        ray = Ray()
-        convolution = Convolution()
+    elif not global_context.num_threads: # 0 or unspecified
+        ray = construct_ray(global_context)
+        convolution = construct_sampler(global_context)
+        convolutions.append(convolution)
+        rays.append(ray)
         for col in tqdm(range(num_cols), position=0):
             for row in tqdm(range(num_rows), position=1, leave=False):
                 result = ray.go(row, col, convolution, global_context)
-                global_img_out[:, row, col] = result
+                global_img_out[..., row, col] = result
 
     else: # multithread, 1 only incurs locking overhead
         num_threads = global_context.num_threads
@@ -51,8 +113,10 @@ def main():
             targ = SimpleNamespace()
             targ.tid = tid
             # private
-            targ.ray = Ray()
-            targ.convolution = Convolution()
+            targ.ray = construct_ray(global_context)
+            targ.convolution = construct_sampler(global_context)
+            convolutions.append(targ.convolution)
+            rays.append(targ.ray)
             thread_args.append(targ)
 
         with ThreadPoolExecutor(max_workers=num_threads) as executor:
@@ -60,10 +124,75 @@ def main():
 
         global_pbar.close()
 
+    print('render time ({} gradient): {:.2f}s'.format(
+    global_context.gradient_method, time.perf_counter() - time_start))
+
+    stepped = sum(ray.samples_stepped for ray in rays)
+    saved = sum(ray.samples_saved for ray in rays)
+    print('early ray termination at opacity {}: {:.0f} of {:.0f} samples saved ({:.1%})'.format(
+    global_context.transfer_func.alpha_near_one, saved, stepped + saved,
+    saved / max(stepped + saved, 1)))
+    if global_context.adaptive_steps is not None:
+        print('adaptive steps: {} samples evaluated over {:.0f} plane_sep'.format(
+        sum(ray.samples_evaluated for ray in rays), stepped))
+
+    if global_context.block_cache_size and convolutions and \
+    global_context.sampler == 'convo':
+        hits = sum(conv.cache_hits for conv in convolutions)
+        misses = sum(conv.cache_misses for conv in convolutions)
+        total = max(hits + misses, 1)
+        print('block cache: {} hits, {} misses, hit rate {:.1%}'.format(
+        hits, misses, hits / total))
+
+    if params_dict['precision'] != 'float64':
+        deviation, num_pixels = precision_deviation(params_dict, global_img_out)
+        print('deviation from float64, max over {} sampled of {} pixels: {:.3g}'.format(
+        num_pixels, num_rows * num_cols, deviation))
+
     fpath_out = params_dict['fpath_out']
     # TODO: write headers as well
     nrrd.write(fpath_out, global_img_out)
 
+def construct_ray(context):
+    """
+    one per worker, a MultiChannelRay for multi-channel volumes, otherwise
+    a Ray with adaptive steps and/or pre-integrated segments as configured
+    """
+    if context.volume.num_channels is not None:
+        return MultiChannelRay()
+    if context.preintegrated is not None:
+        if context.adaptive_steps is not None:
+            return PreintegratedAdaptiveRay()
+        return PreintegratedRay()
+    if context.adaptive_steps is not None:
+        return AdaptiveRay()
+    return Ray()
+
+def precision_deviation(params_dict, img_out, num_pixels=None):
+    """
+    re-renders num_pixels distinct random pixels in float64, all of them if
+    the image has no more
+    returns the max absolute RGBA difference to img_out over those pixels,
+    and how many there were
+    """
+    if num_pixels is None:
+        num_pixels = PRECISION_CHECK_PIXELS
+    context = construct_context(dict(params_dict, precision='float64'))
+    num_rows, num_cols = context.camera.img_plane_size
+    num_pixels = min(num_pixels, num_rows * num_cols)
+    rng = np.random.default_rng(0)
+    pixels = rng.choice(num_rows * num_cols, size=num_pixels, replace=False)
+    ray = construct_ray(context)
+    convolution = construct_sampler(context)
+    deviation = 0
+    for row, col in zip(*np.unravel_index(pixels, (num_rows, num_cols))):
+        result = ray.go(row, col, convolution, context)
+        diff = np.abs(result - img_out[..., row, col])
+        # both NaN (ray missed the volume) counts as no deviation
+        diff[np.isnan(result) & np.isnan(img_out[..., row, col])] = 0
+        deviation = max(deviation, np.max(diff))
+    return deviation, num_pixels
+
 def thread_func(args):
     global global_context, global_img_out, global_pbar, global_mutex
     global global_row, global_col
@@ -86,7 +215,30 @@ def thread_func(args):
         if col == num_cols:
             break # done
         result = args.ray.go(row, col, args.convolution, global_context)
-        global_img_out[:, row, col] = result
+        global_img_out[..., row, col] = result
+
+def pixel_tiles(num_rows, num_cols, size):
+    """
+    returns a list of (rows, cols), the pixel indices of each size x size tile
+    """
+    tiles = []
+    for col_start in range(0, num_cols, size):
+        for row_start in range(0, num_rows, size):
+            rows, cols = np.meshgrid(np.arange(row_start, min(row_start + size, num_rows)),
+            np.arange(col_start, min(col_start + size, num_cols)), indexing='ij')
+            tiles.append((rows.ravel(), cols.ravel()))
+    return tiles
+
+def packet_thread_func(args):
+    global global_context, global_img_out, global_pbar, global_mutex, global_tiles
+    while True:
+        with global_mutex:
+            if not global_tiles:
+                break # done
+            rows, cols = global_tiles.pop()
+            global_pbar.update(1)
+        results = args.ray.go(rows, cols, args.convolution, global_context)
+        global_img_out[..., rows, cols] = results.T
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Volume rendering and ray marching.')
@@ -99,12 +251,54 @@ def parse_args():
     parser.add_argument('-fov', type=float, required=True)
     parser.add_argument('-us', type=float, required=True)
     parser.add_argument('-s', type=float, required=True)
-    parser.add_argument('-lut', required=True)
+    parser.add_argument('-lut', nargs='+', required=True,
+    help='one LUT, or one per channel of a multi-channel volume')
     parser.add_argument('-lit', required=True)
     parser.add_argument('-sz', type=int, nargs=2, required=True)
     parser.add_argument('-nt', type=int, required=True)
     parser.add_argument('-o', dest='output', required=True)
     parser.add_argument('-ortho', action='store_true')
+    parser.add_argument('-adapt', type=float, nargs=2, metavar=('MIN', 'MAX'),
+    help='adaptive step length between MIN and MAX times -s')
+    parser.add_argument('-preint', action='store_true',
+    help='classify the segments between samples from a pre-integrated LUT, '
+    'for LUTs with narrow opacity features, smooth LUTs do better point-sampled')
+    parser.add_argument('-ant', type=float, default=1,
+    help='opacity at which rays stop early, 1 only stops behind fully opaque samples')
+    parser.add_argument('-packet', type=int, default=0,
+    help='march square tiles of this many pixels per side together, 0 for one ray at a time')
+    parser.add_argument('-noslice', action='store_true',
+    help='do not use the slice engine for axis-aligned orthographic views')
+    parser.add_argument('-k', dest='kernel', choices=sorted(kernel_registry),
+    default='bspln3')
+    parser.add_argument('-pad', action='store_true',
+    help='pad the volume with ghost cells for bounds-check-free gathers')
+    parser.add_argument('-ktab', type=int, default=0,
+    help='tabulate the kernel with this many samples per unit, 0 to disable')
+    parser.add_argument('-cache', type=int, default=0,
+    help='per-thread LRU cache size of gathered neighborhoods, 0 to disable')
+    parser.add_argument('-prec', choices=['float64', 'float32'], default='float64',
+    help='floating-point precision of the volume, LUT, matrices and output')
+    parser.add_argument('-vscl', type=float, nargs=2, default=[1, 0],
+    metavar=('SCALE', 'OFFSET'),
+    help='integer volumes map stored values to data * SCALE + OFFSET')
+    parser.add_argument('-quant', type=int, choices=[0, 8, 16], default=0,
+    help='quantize float volumes to 8 or 16 bits with a scale and offset per brick')
+    parser.add_argument('-brick', type=int, default=16,
+    help='brick size in voxels along each axis for -quant')
+    parser.add_argument('-mcell', type=int, default=0,
+    help='macrocell size in base indices for skipping transparent bricks, 0 to disable')
+    skipping = parser.add_mutually_exclusive_group()
+    skipping.add_argument('-dfield', action='store_true',
+    help='leap by a distance field over the macrocells instead of one macrocell at a time')
+    skipping.add_argument('-octree', action='store_true',
+    help='skip the largest transparent node of an octree over the macrocells')
+    parser.add_argument('-grad', choices=['kernel', 'cdiff'], default='kernel',
+    help='kernel: reconstruction kernel derivative, cdiff: central differences, convo sampler only')
+    parser.add_argument('-uniform', action='store_true',
+    help='skip the convolution where the whole kernel support is constant')
+    parser.add_argument('-sampler', choices=['convo', 'prefilt'], default='convo',
+    help='convo: full convolution, prefilt: trilinear over prefiltered volumes')
 
     args = parser.parse_args()
 
@@ -120,12 +314,30 @@ def parse_args():
     params_dict['params_camera']['field_of_view'] = args.fov
     params_dict['params_camera']['img_plane_size'] = args.sz
     params_dict['params_camera']['ortho'] = args.ortho
+    params_dict['ortho_slices'] = not args.noslice
 
     params_dict['unit_step'] = args.us
     params_dict['plane_sep'] = args.s
     params_dict['num_threads'] = args.nt
     params_dict['outside_val'] = np.nan # TODO
-    params_dict['alpha_near_one'] = 1 # TODO
+    params_dict['alpha_near_one'] = args.ant
+    params_dict['adaptive_steps'] = args.adapt
+    params_dict['preintegrate'] = args.preint
+    params_dict['packet_size'] = args.packet
+    params_dict['kernel'] = args.kernel
+    params_dict['pad_volume'] = args.pad
+    params_dict['kernel_table_res'] = args.ktab
+    params_dict['block_cache_size'] = args.cache
+    params_dict['sampler'] = args.sampler
+    params_dict['gradient_method'] = args.grad
+    params_dict['uniform_skip'] = args.uniform
+    params_dict['precision'] = args.prec
+    params_dict['volume_scale'], params_dict['volume_offset'] = args.vscl
+    params_dict['quantize_bits'] = args.quant
+    params_dict['brick_size'] = args.brick
+    params_dict['macrocell_size'] = args.mcell
+    params_dict['distance_field'] = args.dfield
+    params_dict['octree'] = args.octree
 
     # file paths
     params_dict['fpath_volume'] = args.input
@@ -0,0 +1,162 @@
+import math
+
+import numpy as np
+
+# my modules
+from prefiltered_sampler import dequantize_volume
+
+def sliding_min_max(data, window):
+    """
+    separable sliding min and max over window voxels along each of the
+    last three axes, valid mode, entry [i, j, k] covers data[i:i + window, ...]
+    """
+    lo = hi = data
+    for axis in range(-3, 0):
+        num_out = lo.shape[axis] - window + 1
+        def take(arr, o):
+            idx = [slice(None)] * arr.ndim
+            idx[axis] = slice(o, o + num_out)
+            return arr[tuple(idx)]
+        lo_next, hi_next = take(lo, 0), take(hi, 0)
+        for o in range(1, window):
+            lo_next = np.minimum(lo_next, take(lo, o))
+            hi_next = np.maximum(hi_next, take(hi, o))
+        lo, hi = lo_next, hi_next
+    return lo, hi
+
+class MacrocellGrid():
+    """
+    min and max of the reconstructed values over bricks of brick_size^3 base
+    indices of the valid convolution box, with per-brick flags telling whether
+    the current transfer function maps the whole brick to zero opacity
+    brick [i, j, k] holds base indices valid_lo + brick_size * (i, j, k) onwards
+    """
+    def __init__(self, volume, kernel, brick_size, valid_lo, valid_hi):
+        self.brick_size = brick_size
+        self.valid_lo = valid_lo
+        self.valid_hi = valid_hi
+        # base indices are floor(p + 0.5) for odd supports, floor(p) for even ones
+        self.shift = 0.5 if kernel.support & 1 else 0
+        self.transparent = None
+
+        # voxel min and max over the support of each base index and of its two
+        # neighbors along every axis, which also covers the second corner of a
+        # trilinear cell of prefiltered values
+        data = np.pad(dequantize_volume(volume), 1, mode='edge')
+        lo, hi = sliding_min_max(data, kernel.support + 2)
+        starts = [np.arange(0, n, brick_size) for n in lo.shape]
+        for axis in range(3):
+            lo = np.minimum.reduceat(lo, starts[axis], axis=axis)
+            hi = np.maximum.reduceat(hi, starts[axis], axis=axis)
+
+        # widen for the kernel: value = sum_i w_i v_i with v_i in [lo, hi]
+        # lies within sum(w) * center +- sum(|w|) * radius
+        l1_norm, sum_lo, sum_hi = self.weight_bounds(kernel)
+        center = (lo + hi) / 2
+        radius = (hi - lo) / 2
+        self.lo = np.minimum(sum_lo * center, sum_hi * center) - l1_norm * radius
+        self.hi = np.maximum(sum_lo * center, sum_hi * center) + l1_norm * radius
+
+    @staticmethod
+    def weight_bounds(kernel, num=1025):
+        """
+        returns bounds on the 3D kernel weights over all sample positions,
+        (max sum |w|, min sum w, max sum w), with a little slack
+        since the kernel is only sampled at num fractional offsets
+        """
+        if kernel.support & 1: # odd support
+            alphas = np.linspace(-0.5, 0.5, num)
+        else:
+            alphas = np.linspace(0, 1, num)
+        weights, _ = kernel.weights(alphas)
+        l1_norm = np.max(np.sum(np.fabs(weights), axis=1)) ** 3
+        sums = np.sum(weights, axis=1)
+        sum_lo, sum_hi = np.min(sums) ** 3, np.max(sums) ** 3
+        slack = 1e-3
+        return l1_norm * (1 + slack), sum_lo * (1 - slack), sum_hi * (1 + slack)
+
+    def classify(self, transfer_func):
+        """
+        sets self.transparent, True for bricks every sample of which maps to
+        zero opacity, cheap enough to redo on every transfer function change
+        """
+        self.transparent = transparent_ranges(transfer_func, self.lo, self.hi)
+        return self.transparent
+
+    def brick_of(self, pos_index):
+        """
+        returns the brick holding the base index of pos_index, or None if
+        pos_index is outside the valid box
+        """
+        brick = []
+        for axis in range(3):
+            base = math.floor(pos_index[axis] + self.shift)
+            if not self.valid_lo[axis] <= base <= self.valid_hi[axis]:
+                return None
+            brick.append((base - self.valid_lo[axis]) // self.brick_size)
+        return tuple(brick)
+
+    def brick_box(self, brick_lo, brick_hi):
+        """
+        returns the inclusive (base_lo, base_hi) box of base indices covered by
+        bricks brick_lo through brick_hi, clipped to the valid box
+        """
+        base_lo = np.maximum(self.valid_lo + np.asarray(brick_lo) * self.brick_size,
+        self.valid_lo)
+        base_hi = np.minimum(self.valid_lo + (np.asarray(brick_hi) + 1) * self.brick_size - 1,
+        self.valid_hi)
+        return base_lo, base_hi
+
+    def skippable_samples(self, pos_index, step_index):
+        """
+        returns how many samples pos_index + j * step_index, j = 0, 1, ...
+        lie in the same transparent brick as pos_index, 0 if its brick is
+        not transparent or pos_index is outside the valid box
+        """
+        brick = self.brick_of(pos_index)
+        if brick is None or not self.transparent[brick]:
+            return 0
+        base_lo, base_hi = self.brick_box(brick, brick)
+        return samples_in_box(pos_index, step_index, base_lo, base_hi, self.shift)
+
+def samples_in_box(pos_index, step_index, base_lo, base_hi, shift):
+    """
+    returns how many samples pos_index + j * step_index, j = 0, 1, ... have
+    their base index in the inclusive box [base_lo, base_hi], given that
+    the first one does, with slack for the rounding of the sample positions
+    """
+    slack = 1e-3
+    t_exit = math.inf
+    for axis in range(3):
+        step = step_index[axis]
+        if step > 0:
+            t_exit = min(t_exit, (base_hi[axis] + 1 - shift - slack - pos_index[axis]) / step)
+        elif step < 0:
+            t_exit = min(t_exit, (base_lo[axis] - shift + slack - pos_index[axis]) / step)
+    return max(0, math.floor(t_exit)) + 1
+
+def quantize_bounds(transfer_func, values):
+    """
+    LUT indices of values, as in utils.quantize_many, NaN mapped to 0
+    """
+    step = (transfer_func.vmax - transfer_func.vmin) / transfer_func.len
+    idx = np.floor((np.nan_to_num(values) - transfer_func.vmin) / step)
+    return np.clip(idx, 0, transfer_func.len - 1).astype(int)
+
+def opaque_before(transfer_func):
+    """
+    number of opaque LUT entries before each index, len + 1 of them
+    """
+    return np.concatenate([[0], np.cumsum(transfer_func.rgba[3] > 0)])
+
+def transparent_ranges(transfer_func, lo, hi):
+    """
+    elementwise over value bounds lo <= hi, True where every LUT entry
+    from that of lo to that of hi has zero opacity
+    """
+    prefix = opaque_before(transfer_func)
+    lo_idx = quantize_bounds(transfer_func, lo)
+    hi_idx = quantize_bounds(transfer_func, hi)
+    transparent = prefix[hi_idx + 1] == prefix[lo_idx]
+    # NaN voxels give NaN bounds, never skip those
+    return transparent & ~np.isnan(lo) & ~np.isnan(hi)
@@ -0,0 +1,65 @@
+import numpy as np
+
+# my modules
+from ray import Ray
+from shading import classify_many, blinn_phong_many, depth_cue_many, blend_over_many
+
+class MultiChannelRay(Ray):
+    """
+    Ray over a multi-channel volume, every channel is composited separately
+    but each sample is convolved once, with the kernel weights shared by all channels
+    result is (num_channels, 4)
+    """
+    def start(self, idx_horizontal, idx_vertical, convolution, context):
+        super().start(idx_horizontal, idx_vertical, convolution, context)
+        num_channels = context.volume.num_channels
+        self.result = np.full((num_channels, 4), context.outside_val, dtype=context.dtype)
+        self.transparency = np.ones(num_channels, dtype=context.dtype)
+        # whether a channel has blended its first sample, and has not stopped early
+        self.started = np.zeros(num_channels, dtype=bool)
+        self.active = np.ones(num_channels, dtype=bool)
+
+    def step(self, convolution, context):
+        """
+        rndProbeRgbaLit for all channels at once
+        returns a boolean, keepgoing, False once every channel stopped early
+        """
+        camera = context.camera
+        sample_idx = self.sample_idx
+        # past the valid box, nothing left to blend
+        if sample_idx > self.sample_last:
+            return False
+        pos_view_z = self.pos_view_init[2, 0] + sample_idx * self.step_view[2, 0]
+        # stop when -p_n > fcv
+        if -pos_view_z > camera.far_clip_view:
+            return False # no need to keep going
+        self.sample_idx += 1
+
+        pos_index = self.pos_index_init + sample_idx * self.step_index
+        convolution.evaluate_index(pos_index[0], pos_index[1], pos_index[2], context,
+        gradient=False)
+
+        if not convolution.inside:
+            return True # skip this sample, proceed to the next
+
+        idx = np.flatnonzero(self.active)
+        # each channel goes through its own transfer function
+        rgba = np.empty((len(idx), 4), dtype=context.dtype)
+        for i, channel in enumerate(idx):
+            rgba[i] = classify_many(convolution.value[channel:channel + 1],
+            self.step_view_len, context.transfer_funcs[channel])[0]
+
+        # no need to do Blinn-Phong for channels with corrected opacity 0
+        contributes = rgba[:, 3] != 0
+        if contributes.any():
+            convolution.evaluate_gradient(context)
+            gradients = convolution.gradient.T[idx[contributes]]
+            viewer_dir = self.viewer_direction(sample_idx, context).squeeze()[:3]
+            rgba[contributes, :3] = blinn_phong_many(rgba[contributes, :3],
+            gradients, viewer_dir, context)
+        rgba[:, :3] *= depth_cue_many(pos_view_z, context)
+
+        keepgoing = blend_over_many(self.result, self.transparency, self.started,
+        rgba, idx, context.transfer_func.alpha_near_one)
+        self.active[idx] = keepgoing
+        return self.active.any()
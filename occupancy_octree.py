@@ -0,0 +1,55 @@
+import numpy as np
+
+# my modules
+from macrocell_grid import samples_in_box, transparent_ranges
+
+class OccupancyOctree():
+    """
+    octree over the bricks of a macrocell grid, level 0 is the grid itself and
+    node [i, j, k] of level l covers bricks 2^l * (i, j, k) up to the next node
+    every node stores the value range of its bricks and, for the current
+    transfer function, whether that range maps to zero opacity
+    """
+    def __init__(self, macrocells):
+        self.macrocells = macrocells
+        self.lo = [macrocells.lo]
+        self.hi = [macrocells.hi]
+        # merge 2x2x2 nodes until a single root is left
+        while max(self.lo[-1].shape) > 1:
+            lo, hi = self.lo[-1], self.hi[-1]
+            for axis in range(3):
+                starts = np.arange(0, lo.shape[axis], 2)
+                lo = np.minimum.reduceat(lo, starts, axis=axis)
+                hi = np.maximum.reduceat(hi, starts, axis=axis)
+            self.lo.append(lo)
+            self.hi.append(hi)
+        self.transparent = None
+
+    def classify(self, transfer_func):
+        """
+        sets self.transparent, one boolean array per level
+        """
+        self.transparent = [transparent_ranges(transfer_func, lo, hi)
+        for lo, hi in zip(self.lo, self.hi)]
+        return self.transparent
+
+    def skippable_samples(self, pos_index, step_index):
+        """
+        returns how many samples pos_index + j * step_index, j = 0, 1, ...
+        lie in the largest transparent node holding pos_index, 0 if its
+        brick is not transparent or pos_index is outside the valid box
+        """
+        macrocells = self.macrocells
+        brick = macrocells.brick_of(pos_index)
+        # a node is only transparent if all of its bricks are
+        if brick is None or not self.transparent[0][brick]:
+            return 0
+        # descend from the root to the first transparent node
+        for level in range(len(self.transparent) - 1, -1, -1):
+            node = tuple(i >> level for i in brick)
+            if self.transparent[level][node]:
+                break
+        brick_lo = np.left_shift(node, level)
+        brick_hi = np.left_shift(np.add(node, 1), level) - 1
+        base_lo, base_hi = macrocells.brick_box(brick_lo, brick_hi)
+        return samples_in_box(pos_index, step_index, base_lo, base_hi, macrocells.shift)
@@ -0,0 +1,191 @@
+import math
+
+import numpy as np
+
+# my modules
+from utils import lerp5
+from ray import clip_many, count_samples
+from convolution import dequantize
+from prefiltered_sampler import trilinear_many
+from shading import shade_many, blend_over_many
+
+class OrthoSliceEngine():
+    """
+    renders orthographic views whose image axes and view direction all line up
+    with volume index axes
+    every sample plane is then a resampled volume slice: the index coordinate
+    along the view axis is shared by the whole plane, and the other two depend
+    only on the image row resp. column, so kernel weights are computed once per
+    plane, row and column and the planes come out of separable 1-D filtering
+    """
+    def __init__(self, context, tolerance=1e-9):
+        self.axes = self.aligned_axes(context, tolerance)
+        # totals over all rays marched, for reporting early ray termination
+        self.samples_stepped = 0 # from the first sample to where each ray stopped
+        self.samples_saved = 0 # left before the far clip or the volume exit
+
+    @staticmethod
+    def aligned_axes(context, tolerance=1e-9):
+        """
+        returns the index axes (a_u, a_v, a_n) that the view-space u, v and n
+        axes map to, or None if the view is not orthographic and axis-aligned
+        """
+        if not context.camera.ortho:
+            return None
+        mat = np.abs(context.VtoI[:3, :3].astype(float))
+        axes = tuple(int(i) for i in np.argmax(mat, axis=0))
+        if len(set(axes)) != 3:
+            return None
+        for col, axis in enumerate(axes):
+            off_axis = np.delete(mat[:, col], axis)
+            if np.any(off_axis > tolerance * mat[axis, col]):
+                return None
+        return axes
+
+    def render(self, context):
+        """
+        returns the (4, size_h, size_v) RGBA image Ray.go would produce
+        """
+        camera = context.camera
+        dtype = context.dtype
+        size_h, size_v = camera.img_plane_size
+        a_u, a_v, a_n = self.axes
+        VtoI = context.VtoI
+
+        # view-space coordinates of the pixels, as in Ray.start
+        view_u = (camera.img_plane_width / 2) * \
+        lerp5(-1, 1, -0.5, np.arange(size_h, dtype=dtype), size_h - 0.5)
+        view_v = (camera.img_plane_height / 2) * \
+        lerp5(1, -1, -0.5, np.arange(size_v, dtype=dtype), size_v - 0.5)
+        # index coordinates along each aligned axis
+        index_u = VtoI[a_u, 0] * view_u + VtoI[a_u, 3]
+        index_v = VtoI[a_v, 1] * view_v + VtoI[a_v, 3]
+        base_u, wu, du, valid_u = self.axis_weights(index_u, a_u, context)
+        base_v, wv, dv, valid_v = self.axis_weights(index_v, a_v, context)
+
+        # slices of the volume are taken along a_n, with a_u, a_v first
+        data = np.transpose(context.volume.data, (a_u, a_v, a_n))
+        offsets = np.arange(context.idx_start, context.idx_end + 1)
+        # only the rows and columns the pixels reach are filtered
+        u_idx = base_u[:, np.newaxis] + offsets
+        v_idx = base_v[:, np.newaxis] + offsets
+        u_lo, u_hi = self.index_range(u_idx, valid_u)
+        v_lo, v_hi = self.index_range(v_idx, valid_v)
+        u_idx = np.clip(u_idx, u_lo, u_hi) - u_lo
+        v_idx = np.clip(v_idx, v_lo, v_hi) - v_lo
+
+        num_rays = size_h * size_v
+        result = np.full((num_rays, 4), context.outside_val, dtype=dtype)
+        # float64 like the scalar products in Ray.blend, whatever the precision
+        transparency = np.ones(num_rays)
+        started = np.zeros(num_rays, dtype=bool)
+        active = np.ones(num_rays, dtype=bool)
+        # rays are ordered [h, v], like the output image
+        valid_pixels = (valid_u[:, np.newaxis] & valid_v).ravel()
+        alpha_near_one = context.transfer_func.alpha_near_one
+        viewer_dir = camera.n.squeeze()
+        step_view_z = -context.plane_sep
+
+        # the samples each ray would march in Ray.go, for the early ray
+        # termination report, rays ordered [h, v]
+        pos_view = np.empty((num_rays, 4), dtype=dtype)
+        pos_view[:, 0] = np.repeat(view_u, size_v)
+        pos_view[:, 1] = np.tile(view_v, size_h)
+        pos_view[:, 2] = -camera.near_clip_view
+        pos_view[:, 3] = 1
+        pos_index_init = pos_view @ VtoI[:3].T
+        step_index = VtoI[:3, :3] @ np.array([0, 0, step_view_z], dtype=dtype)
+        sample_first, sample_last = clip_many(pos_index_init,
+        np.broadcast_to(step_index, (num_rays, 3)), context)
+        pos_view_z_init = dtype(-camera.near_clip_view)
+        sample_far = math.floor((camera.far_clip_view + pos_view_z_init) / -step_view_z) - 1
+        # sample each ray stopped before, set where early termination stops it
+        sample_end = np.full(num_rays, -1)
+
+        sample_idx = 0
+        while True:
+            pos_view_z = -camera.near_clip_view + sample_idx * step_view_z
+            # stop when -p_n > fcv
+            if -pos_view_z > camera.far_clip_view:
+                break
+            index_n = np.array([VtoI[a_n, 2] * pos_view_z + VtoI[a_n, 3]], dtype=dtype)
+            sample_idx += 1
+            base_n, wn, dn, valid_n = self.axis_weights(index_n, a_n, context)
+            if not valid_n[0]:
+                continue
+            idx = np.flatnonzero(valid_pixels & active)
+            if len(idx) == 0:
+                continue
+
+            # (U, V, support) slab along a_n, restricted to the reached rows/columns
+            slab = data[u_lo:u_hi + 1, v_lo:v_hi + 1, base_n[0] + offsets]
+            index = [None] * 3 # in volume axis order, broadcasting to the slab
+            index[a_u] = np.arange(u_lo, u_hi + 1)[:, np.newaxis, np.newaxis]
+            index[a_v] = np.arange(v_lo, v_hi + 1)[np.newaxis, :, np.newaxis]
+            index[a_n] = (base_n[0] + offsets)[np.newaxis, np.newaxis, :]
+            slab = dequantize(slab, context.volume, dtype, tuple(index))
+            slab_n = slab @ wn[0] # (U, V)
+            slab_nv = np.einsum('uvs,vs->uv', slab_n[:, v_idx], wv) # (U, size_v)
+            values = np.einsum('hsv,hs->hv', slab_nv[u_idx], wu).ravel()[idx]
+
+            def gradient_func(mask):
+                if context.gradient_method == 'cdiff':
+                    h, v = np.unravel_index(idx[mask], (size_h, size_v))
+                    pos = np.empty((len(h), 3), dtype=dtype)
+                    pos[:, a_u] = index_u[h]
+                    pos[:, a_v] = index_v[v]
+                    pos[:, a_n] = index_n[0]
+                    grad = trilinear_many(context.gradient_volume, pos)
+                    return grad @ context.gradient_ItoW.T
+                # index-space gradient, one 1-D derivative pass per axis
+                slab_dn = slab @ dn[0]
+                grad = np.empty((size_h, size_v, 3), dtype=dtype)
+                grad[..., a_u] = np.einsum('hsv,hs->hv', slab_nv[u_idx], du)
+                grad[..., a_v] = np.einsum('hsv,hs->hv',
+                np.einsum('uvs,vs->uv', slab_n[:, v_idx], dv)[u_idx], wu)
+                grad[..., a_n] = np.einsum('hsv,hs->hv',
+                np.einsum('uvs,vs->uv', slab_dn[:, v_idx], wv)[u_idx], wu)
+                grad = grad.reshape(num_rays, 3)[idx[mask]]
+                return grad @ context.gradient_ItoW.T
+
+            rgba = shade_many(values, np.abs(step_view_z), pos_view_z,
+            gradient_func, viewer_dir, context)
+            keepgoing = blend_over_many(result, transparency, started, rgba, idx,
+            alpha_near_one)
+            active[idx[~keepgoing]] = False
+            sample_end[idx[~keepgoing]] = sample_idx
+
+        # the rest ran to the valid box exit or the far clip, at sample_idx
+        running = sample_end < 0
+        sample_end[running] = np.maximum(sample_first[running],
+        np.minimum(sample_last[running] + 1, sample_idx))
+        stepped, saved = count_samples(sample_first, sample_end, sample_last, sample_far)
+        self.samples_stepped += stepped
+        self.samples_saved += saved
+
+        return result.reshape(size_h, size_v, 4).transpose(2, 0, 1)
+
+    @staticmethod
+    def axis_weights(index, axis, context):
+        """
+        base indices, kernel weights and derivatives along one axis
+        returns base (N,), weights (N, support), derivatives (N, support) and
+        valid (N,) for the index coordinates in index
+        """
+        if context.kernel.support & 1: # odd support
+            base = np.floor(index + 0.5)
+        else:
+            base = np.floor(index)
+        weights, derivatives = context.kernel.weights(index - base)
+        base = base.astype(int)
+        valid = (context.valid_lo[axis] <= base) & (base <= context.valid_hi[axis])
+        return base, weights, derivatives, valid
+
+    @staticmethod
+    def index_range(idx, valid):
+        """
+        smallest and largest volume index used by the valid rows of idx
+        """
+        if not valid.any():
+            return 0, 0
+        return idx[valid].min(), idx[valid].max()
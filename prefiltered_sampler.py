@@ -0,0 +1,205 @@
+import math
+
+import numpy as np
+
+# prefiltered volumes by (volume path, quantization, kernel name), go.py renders
+# one view per run, so this only saves the rebuild when precision_deviation
+# sets up a second, float64 context for the same volume
+prefilter_cache = {}
+
+def volume_key(volume):
+    """
+    hashable key identifying the loaded volume, for caches of derived volumes
+    None if the volume does not come from a file
+    """
+    if getattr(volume, 'fpath', None) is None:
+        return None
+    if volume.brick_size is None:
+        quantization = (volume.scale, volume.offset)
+    else: # per-brick arrays follow from the file and the brick settings
+        quantization = (volume.data.dtype.str, volume.brick_size)
+    return (volume.fpath,) + quantization
+
+def dequantize_volume(volume):
+    """
+    returns the whole volume as float64, applying value = stored * scale + offset
+    to integer volumes, with the scale and offset of its brick if quantized per brick
+    """
+    data = volume.data.astype(float)
+    if volume.scale is None: # float volume
+        return data
+    if volume.brick_size is None:
+        return data * volume.scale + volume.offset
+    shape = data.shape[-3:]
+    scale, offset = volume.scale, volume.offset
+    for axis in range(3):
+        scale = np.repeat(scale, volume.brick_size, axis=axis)
+        offset = np.repeat(offset, volume.brick_size, axis=axis)
+    crop = tuple(slice(0, n) for n in shape)
+    return data * scale[crop] + offset[crop]
+
+def filter_axis(data, taps, axis):
+    """
+    valid-mode correlation of data with taps along one axis
+    out[i] = sum_o taps[o] * data[i + o], shrinking that axis by len(taps) - 1
+    """
+    num_out = data.shape[axis] - len(taps) + 1
+    out = np.zeros(data.shape[:axis] + (num_out,) + data.shape[axis + 1:])
+    for o, tap in enumerate(taps):
+        if tap == 0:
+            continue
+        idx = [slice(None)] * data.ndim
+        idx[axis] = slice(o, o + num_out)
+        out += tap * data[tuple(idx)]
+    return out
+
+def prefilter_volume(volume, kernel):
+    """
+    runs the reconstruction kernel and its derivative separably over the grid
+    returns float32 (X', Y', Z', 4) holding the value and the three index-space
+    gradient components at every base index of the valid convolution box
+    entry [i, j, k] belongs to base index valid_lo + (i, j, k)
+    """
+    key = volume_key(volume)
+    if key is not None:
+        key += (kernel.name,)
+        if key in prefilter_cache:
+            return prefilter_cache[key]
+
+    support = kernel.support
+    if support & 1: # odd support
+        idx_start = (1 - support) // 2
+    else:
+        idx_start = 1 - support // 2
+    offsets = np.arange(idx_start, idx_start + support)
+    # at a grid point alpha is 0, so the weight of data[i + o] is k(-o)
+    taps = kernel.apply(-offsets.astype(float))
+    taps_deriv = kernel.apply_derivative(-offsets.astype(float))
+
+    data = dequantize_volume(volume)
+    # share the passes that the value and the gradients have in common
+    wz = filter_axis(data, taps, 2)
+    dz = filter_axis(data, taps_deriv, 2)
+    wz_wy = filter_axis(wz, taps, 1)
+    wz_dy = filter_axis(wz, taps_deriv, 1)
+    dz_wy = filter_axis(dz, taps, 1)
+    prefiltered = np.stack([
+        filter_axis(wz_wy, taps, 0),
+        filter_axis(wz_wy, taps_deriv, 0),
+        filter_axis(wz_dy, taps, 0),
+        filter_axis(dz_wy, taps, 0),
+    ], axis=-1).astype(np.float32)
+
+    if key is not None:
+        prefilter_cache[key] = prefiltered
+    return prefiltered
+
+def central_difference_volume(volume, dtype):
+    """
+    index-space gradient of the voxel data by central differences
+    (one-sided at the borders), returns (X, Y, Z, 3) in dtype
+    """
+    data = dequantize_volume(volume)
+    return np.stack(np.gradient(data), axis=-1).astype(dtype)
+
+def trilinear(grid, x, y, z, dtype):
+    """
+    trilinear interpolation of the (X, Y, Z, C) grid at one position
+    the cell at floor of the position must lie in the grid
+    returns a len-C vector
+    """
+    xn = math.floor(x)
+    yn = math.floor(y)
+    zn = math.floor(z)
+    xalpha = x - xn
+    yalpha = y - yn
+    zalpha = z - zn
+    corners = grid[xn:xn + 2, yn:yn + 2, zn:zn + 2]
+    return np.einsum('ijkc,i,j,k->c', corners,
+    np.array([1 - xalpha, xalpha], dtype=dtype), np.array([1 - yalpha, yalpha], dtype=dtype),
+    np.array([1 - zalpha, zalpha], dtype=dtype))
+
+def trilinear_many(grid, pos):
+    """
+    batched version of trilinear, pos is (N, 3), returns (N, C)
+    """
+    base = np.floor(pos)
+    alpha = pos - base
+    base = base.astype(int)
+    res = np.zeros((len(pos), grid.shape[-1]), dtype=pos.dtype)
+    for corner in np.ndindex(2, 2, 2):
+        weight = np.prod(np.where(corner, alpha, 1 - alpha), axis=1)
+        idx = base + corner
+        res += weight[:, np.newaxis] * grid[idx[:, 0], idx[:, 1], idx[:, 2]]
+    return res
+
+class PrefilteredSampler():
+    """
+    drop-in replacement for Convolution for preview renders
+    trilinearly interpolates the value and gradient volumes built by
+    prefilter_volume, 8 taps per sample instead of support ** 3
+    """
+
+    def evaluate(self, x_world, y_world, z_world, context, gradient=True):
+        pos_world = np.array([[x_world, y_world, z_world, 1]]).T # column vec
+        self.pos_index = context.WtoI @ pos_world
+        x_index, y_index, z_index, _ = self.pos_index.squeeze()
+        self.evaluate_index(x_index, y_index, z_index, context, gradient)
+
+    def evaluate_index(self, x_index, y_index, z_index, context, gradient=True):
+        self.value = None
+        self.gradient = None # world-space gradients
+
+        prefiltered = context.prefiltered
+        size_x, size_y, size_z, _ = prefiltered.shape
+        lo_x, lo_y, lo_z = context.valid_lo
+        # position relative to the first prefiltered grid point
+        x = x_index - lo_x
+        y = y_index - lo_y
+        z = z_index - lo_z
+        # both corners of the cell must have been prefiltered
+        self.inside = 0 <= math.floor(x) < size_x - 1 and \
+        0 <= math.floor(y) < size_y - 1 and 0 <= math.floor(z) < size_z - 1
+        if not self.inside:
+            return
+
+        res = trilinear(prefiltered, x, y, z, context.dtype)
+        self.value = res[0]
+        self.gradient_index = res[1:, np.newaxis]
+        if gradient:
+            self.evaluate_gradient(context)
+
+    def evaluate_gradient(self, context):
+        self.gradient = context.gradient_ItoW @ self.gradient_index
+
+    def evaluate_many(self, pos_world, context, gradient=True):
+        """
+        batched version of evaluate, same return values as
+        Convolution.evaluate_many
+        """
+        pos_world = np.asarray(pos_world, dtype=context.dtype).reshape(-1, 3)
+        pos_index = pos_world @ context.WtoI[:3, :3].T + context.WtoI[:3, 3]
+        return self.evaluate_many_index(pos_index, context, gradient)
+
+    def evaluate_many_index(self, pos_index, context, gradient=True):
+        """
+        same as evaluate_many, but takes (N, 3) index-space positions
+        """
+        pos_index = np.asarray(pos_index, dtype=context.dtype).reshape(-1, 3)
+        num = pos_index.shape[0]
+        prefiltered = context.prefiltered
+        size = np.array(prefiltered.shape[:3])
+        pos = pos_index - context.valid_lo
+        base = np.floor(pos).astype(int)
+        inside = np.all((0 <= base) & (base < size - 1), axis=1)
+
+        values = np.full(num, np.nan, dtype=context.dtype)
+        gradients = np.full((num, 3), np.nan, dtype=context.dtype) if gradient else None
+        if not inside.any():
+            return values, gradients, inside
+
+        res = trilinear_many(prefiltered, pos[inside])
+        values[inside] = res[:, 0]
+        if gradient:
+            gradients[inside] = res[:, 1:] @ context.gradient_ItoW.T
+        return values, gradients, inside
@@ -0,0 +1,145 @@
+import math
+
+import numpy as np
+
+# my modules
+from macrocell_grid import opaque_before
+
+# tables by (LUT path, unit step), held in float64 whatever the precision, so
+# the float64 context of precision_deviation looks segments up in the step
+# classes the render already built rather than building them again
+preintegration_cache = {}
+
+# step length classes per doubling of the step length, a lookup rescales the
+# opacity of the nearest class to its exact step length
+CLASSES_PER_DOUBLING = 8
+# sub-segments composited per table entry
+NUM_SUBSEGMENTS = 16
+# opacity cap for the extinction integral, keeps it finite for opacity 1
+MAX_OPACITY = 1 - 1e-9
+
+def preintegration_table(transfer_func):
+    """
+    returns the PreintegrationTable of transfer_func, cached per LUT
+    """
+    key = None
+    if getattr(transfer_func, 'fpath', None) is not None:
+        key = (transfer_func.fpath, transfer_func.unit_step)
+        if key in preintegration_cache:
+            return preintegration_cache[key]
+    table = PreintegrationTable(transfer_func)
+    if key is not None:
+        preintegration_cache[key] = table
+    return table
+
+class PreintegrationTable():
+    """
+    rgba of ray segments whose value varies linearly from a front to a back
+    sample, indexed by (step class, front LUT index, back LUT index)
+    opacities follow the same correction as Ray.classify, color is the
+    attenuated integral over the segment divided by the segment opacity
+    step classes are built on first use, lookups return float64
+    """
+    def __init__(self, transfer_func):
+        self.transfer_func = transfer_func
+        self.tables = {} # step class to (len, len, 4) array
+
+        num = transfer_func.len
+        self.bin_width = (transfer_func.vmax - transfer_func.vmin) / num
+        rgba = transfer_func.rgba.astype(float)
+        # extinction per unit length, so that a constant stretch of length d has
+        # opacity 1 - (1 - alpha) ^ (d / unit_step)
+        alpha = np.clip(rgba[3], 0, MAX_OPACITY)
+        self.extinction = -np.log1p(-alpha) / transfer_func.unit_step
+        self.color = rgba[:3].T
+        # integrals over value of the extinction and of the extinction-weighted
+        # color, at the bin edges, relative to vmin
+        weighted = np.concatenate([self.extinction[:, np.newaxis],
+        self.color * self.extinction[:, np.newaxis]], axis=1)
+        self.integral = np.concatenate([np.zeros((1, 4)),
+        np.cumsum(weighted, axis=0) * self.bin_width])
+        self.opaque_before = opaque_before(transfer_func)
+
+    def step_class(self, step_len):
+        return round(CLASSES_PER_DOUBLING *
+        math.log2(step_len / self.transfer_func.unit_step))
+
+    def lookup(self, idx_front, idx_back, step_len):
+        """
+        returns a copy of the rgba of a segment of view-space length step_len
+        """
+        lo, hi = min(idx_front, idx_back), max(idx_front, idx_back)
+        if self.opaque_before[hi + 1] == self.opaque_before[lo]:
+            # transparent all the way, no table needed
+            return np.append(self.color[idx_back], 0)
+        step_class = self.step_class(step_len)
+        class_len = self.transfer_func.unit_step * 2 ** (step_class / CLASSES_PER_DOUBLING)
+        table = self.tables.get(step_class)
+        if table is None:
+            table = self.build(class_len)
+            self.tables[step_class] = table
+        rgba = table[idx_front, idx_back].copy()
+        # exact for segments of constant value, the same correction as Ray.classify
+        rgba[3] = 1 - pow(1 - rgba[3], step_len / class_len)
+        return rgba
+
+    def integrals(self, bins):
+        """
+        extinction and color integrals at fractional bin positions, stacked
+        along the last axis
+        """
+        below = np.minimum(bins.astype(int), self.transfer_func.len - 1)
+        frac = (bins - below)[..., np.newaxis]
+        return (1 - frac) * self.integral[below] + frac * self.integral[below + 1]
+
+    def build(self, step_len):
+        """
+        the (len, len, 4) table for segments of length step_len, front to back
+        over NUM_SUBSEGMENTS pieces, each with its exact extinction and mean
+        color under a linear change of value
+        only segments whose value range holds opacity are composited, the
+        rest are transparent with the back sample color
+        """
+        num = self.transfer_func.len
+        table = np.zeros((num, num, 4))
+        table[..., :3] = self.color[np.newaxis, :, :]
+        # pairs of bins, front to back, with an opaque bin in between
+        prefix = self.opaque_before
+        lo = np.minimum.outer(np.arange(num), np.arange(num))
+        hi = np.maximum.outer(np.arange(num), np.arange(num))
+        idx_front, idx_back = np.nonzero(prefix[hi + 1] > prefix[lo])
+        # front and back values at the bin centers, in fractional bins
+        front = idx_front + 0.5
+        back = idx_back + 0.5
+        constant = idx_front == idx_back
+        sub_len = step_len / NUM_SUBSEGMENTS
+
+        transparency = np.ones(len(front))
+        premultiplied = np.zeros((len(front), 3))
+        bins_a = front
+        integral_a = self.integrals(bins_a)
+        for i in range(1, NUM_SUBSEGMENTS + 1):
+            bins_b = front + (back - front) * i / NUM_SUBSEGMENTS
+            integral_b = self.integrals(bins_b)
+            change = integral_b - integral_a
+            # optical depth and mean color of the piece, from the integrals over
+            # value, or from the bin itself if the value does not change
+            mid = np.minimum(((bins_a + bins_b) / 2).astype(int), num - 1)
+            depth = self.extinction[mid]
+            color = self.color[mid]
+            width = (bins_b - bins_a) * self.bin_width
+            depth[~constant] = change[~constant, 0] / width[~constant]
+            weighted = np.abs(change[:, 0]) > 0
+            color[weighted] = change[weighted, 1:] / change[weighted, :1]
+
+            piece_alpha = -np.expm1(-depth * sub_len)
+            premultiplied += (transparency * piece_alpha)[:, np.newaxis] * color
+            transparency *= 1 - piece_alpha
+            bins_a, integral_a = bins_b, integral_b
+
+        alpha = 1 - transparency
+        opaque = alpha > 0
+        table[idx_front, idx_back, 3] = alpha
+        table[idx_front[opaque], idx_back[opaque], :3] = \
+        premultiplied[opaque] / alpha[opaque, np.newaxis]
+        return table
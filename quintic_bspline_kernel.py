@@ -0,0 +1,97 @@
+# kernel.c
+import numpy as np
+
+class QuinticBsplineKernel():
+    """
+    quintic B-spline, support 6
+    """
+    def __init__(self):
+        self.name = 'bspln5'
+        self.support = 6
+
+    def evaluate(self, xx):
+        ret = 0
+        x = np.fabs(xx)
+        if x < 1:
+            ret = (66 + x * x * (-60 + x * x * (30 - 10 * x))) / 120
+        elif x < 2:
+            ret = (51 + x * (75 + x * (-210 + x * (150 + x * (-45 + 5 * x))))) / 120
+        elif x < 3:
+            x = 3 - x
+            ret = x * x * x * x * x / 120
+        return ret
+
+    def apply(self, xs):
+        """
+        vectorized version of evaluate, xs is a vector
+        """
+        ret = np.zeros(xs.shape)
+        x = np.fabs(xs)
+        ret = np.where(x < 1,
+        (66 + x * x * (-60 + x * x * (30 - 10 * x))) / 120, ret)
+        ret = np.where((x >= 1) & (x < 2),
+        (51 + x * (75 + x * (-210 + x * (150 + x * (-45 + 5 * x))))) / 120, ret)
+        three_minus_x = 3 - x
+        ret = np.where((x >= 2) & (x < 3), three_minus_x ** 5 / 120, ret)
+        return ret
+
+    def evaluate_derivative(self, xx):
+        """
+        derivative of quintic B-spline kernel
+        """
+        ret = 0
+        x = np.fabs(xx)
+        if x < 1:
+            ret = x * (-120 + x * x * (120 - 50 * x)) / 120
+        elif x < 2:
+            ret = (75 + x * (-420 + x * (450 + x * (-180 + 25 * x)))) / 120
+        elif x < 3:
+            x = 3 - x
+            ret = -x * x * x * x / 24
+        if xx < 0:
+            return -ret
+        else:
+            return ret
+
+    def apply_derivative(self, xs):
+        ret = np.zeros(xs.shape)
+        x = np.fabs(xs)
+        ret = np.where(x < 1, x * (-120 + x * x * (120 - 50 * x)) / 120, ret)
+        ret = np.where((x >= 1) & (x < 2),
+        (75 + x * (-420 + x * (450 + x * (-180 + 25 * x)))) / 120, ret)
+        three_minus_x = 3 - x
+        ret = np.where((x >= 2) & (x < 3), -three_minus_x ** 4 / 24, ret)
+        ret = np.where(xs < 0, -ret, ret)
+        return ret
+
+    def weights(self, alphas):
+        """
+        weights and derivatives at all support points in one call
+        alphas: floating-point array of fractional offsets in [0, 1), any shape
+        the results have the same dtype as alphas
+        returns (weights, derivatives), each of shape alphas.shape + (6,)
+        entry i holds apply(alpha - (i - 2)) resp. apply_derivative(alpha - (i - 2))
+        """
+        t = np.asarray(alphas)
+        s = 1 - t
+        # the weights are symmetric under t -> 1 - t, entry i <-> entry 5 - i
+        def outer(t):
+            return t ** 5 / 120
+        def middle(t):
+            return (26 + t * (-50 + t * (20 + t * (20 + t * (-20 + 5 * t))))) / 120
+        def inner(t):
+            return (66 + t * t * (-60 + t * t * (30 - 10 * t))) / 120
+        def outer_deriv(t):
+            return t ** 4 / 24
+        def middle_deriv(t):
+            return (-50 + t * (40 + t * (60 + t * (-80 + 25 * t)))) / 120
+        def inner_deriv(t):
+            return t * (-120 + t * t * (120 - 50 * t)) / 120
+        weights = np.stack([
+            outer(s), middle(t), inner(t), inner(s), middle(s), outer(t),
+        ], axis=-1)
+        derivatives = np.stack([
+            -outer_deriv(s), middle_deriv(t), inner_deriv(t),
+            -inner_deriv(s), -middle_deriv(s), outer_deriv(t),
+        ], axis=-1)
+        return weights, derivatives
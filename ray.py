@@ -1,22 +1,77 @@
+import math
+
 import numpy as np
 
 # my modules
 from utils import unlerp, lerp3, lerp5, quantize
 
+def clip_many(pos_index_init, step_index, context):
+    """
+    intersects rays with the valid convolution box in index space
+    pos_index_init, step_index: (N, 3), the k-th sample of ray i is at
+    pos_index_init[i] + k * step_index[i]
+    returns (first, last) sample indices, (N,) each, conservative by one sample
+    on each end so every sample the convolution accepts is marched,
+    first > last where a ray misses the box
+    """
+    # base index floor(p) or floor(p + 0.5) must lie in [valid_lo, valid_hi]
+    shift = 0.5 if context.kernel.support & 1 else 0
+    # slack for the rounding of the sample positions
+    slack = 1e-3
+    lo = context.valid_lo - shift - slack
+    hi = context.valid_hi + 1 - shift + slack
+    pos = np.asarray(pos_index_init, dtype=float)
+    step = np.asarray(step_index, dtype=float)
+    moving = step != 0
+    # a ray parallel to an axis misses unless it lies within the slab
+    missed = np.any(~moving & ~((lo <= pos) & (pos <= hi)), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t0 = (lo - pos) / step
+        t1 = (hi - pos) / step
+    t_lo = np.max(np.where(moving, np.minimum(t0, t1), 0), axis=1)
+    t_hi = np.min(np.where(moving, np.maximum(t0, t1), np.inf), axis=1)
+    missed |= ~(t_lo <= t_hi)
+    first = np.where(missed, 0, np.maximum(0, np.ceil(t_lo) - 1))
+    last = np.where(missed, -1, np.floor(np.where(missed, 0, t_hi)) + 1)
+    return first.astype(int), last.astype(int)
+
+def count_samples(sample_first, sample_end, sample_last, sample_far):
+    """
+    early ray termination report for one ray or arrays of rays, the same for
+    Ray, RayPacket and OrthoSliceEngine
+    a ray marches from sample_first and stops before sample_end, and without
+    early termination would have gone on to min(sample_last, sample_far + 1)
+    returns (stepped, saved), summed over the rays
+    """
+    stepped = np.maximum(0, np.subtract(sample_end, sample_first))
+    saved = np.maximum(0, np.minimum(sample_last, np.add(sample_far, 1)) -
+    np.asarray(sample_end) + 1)
+    return np.sum(stepped), np.sum(saved)
+
 class Ray():
+    def __init__(self):
+        # totals over all rays marched, for reporting early ray termination
+        self.samples_stepped = 0 # from the first sample to where each ray stopped
+        self.samples_saved = 0 # left before the far clip or the volume exit
+
     def start(self, idx_horizontal, idx_vertical, convolution, context):
         """
         rndRayStart
         """
         self.sample_idx = 0 # k-th sample along this ray
+        self.sample_last = None # last sample that can lie in the valid box
+        self.sample_far = None # a sample surely before the far clip
         self.step_view_len = None
         # len-4 vectors, with last entry either np.nan by default
         # or manually set to 1 for view-to-world matrix multiplication
         self.step_view = None
         self.pos_view_init = None
         self.pos_world_init = None
+        # len-3 index-space position of the first sample and per-sample step
+        self.pos_index_init = None
+        self.step_index = None
 
-        self.result = np.full(4, context.outside_val) # 4 for RGBA
+        self.result = np.full(4, context.outside_val, dtype=context.dtype) # 4 for RGBA
         self.result_cache = None
         self.result_curr = None
 
@@ -24,7 +79,7 @@ class Ray():
         self.transparency = None
 
         camera = context.camera
-        ray_img = np.empty((4, 1))
+        ray_img = np.empty((4, 1), dtype=context.dtype)
         ray_img[0] = (camera.img_plane_width / 2) * \
         lerp5(-1, 1, -0.5, idx_horizontal, camera.img_plane_size[0] - 0.5)
         ray_img[1] = (camera.img_plane_height / 2) * \
@@ -33,9 +88,9 @@ class Ray():
         ray_img[3] = np.nan
 
         if camera.ortho:
-            self.pos_view_init = np.array([[ray_img[0, 0], ray_img[0, 1],
-            -camera.near_clip_view, np.nan]]).T
-            self.step_view = np.array([[0, 0, -context.plane_sep, np.nan]]).T
+            self.pos_view_init = np.array([[ray_img[0, 0], ray_img[1, 0],
+            -camera.near_clip_view, np.nan]], dtype=context.dtype).T
+            self.step_view = np.array([[0, 0, -context.plane_sep, np.nan]], dtype=context.dtype).T
         else: # perspective
             scale = camera.near_clip_view / camera.dist
             self.pos_view_init = scale * ray_img
@@ -48,12 +103,35 @@ class Ray():
         self.pos_view_init[3] = 1
         # convert view-space initial position to world-space
         self.pos_world_init = camera.VtoW @ self.pos_view_init
+        # march in index space, the k-th sample is at pos_index_init + k * step_index
+        self.pos_index_init = (context.VtoI @ self.pos_view_init)[:3, 0]
+        self.step_index = context.VtoI[:3, :3] @ self.step_view[:3, 0]
+        # march only over the samples that can reach the valid convolution box
+        self.sample_idx, self.sample_last = self.clip(context)
+        # -(z_init + k * z_step) <= fcv, one sample short against rounding
+        self.sample_far = math.floor((camera.far_clip_view + self.pos_view_init[2, 0]) /
+        -self.step_view[2, 0]) - 1
+
+    def clip(self, context):
+        """
+        clip_many for this ray
+        returns (first, last) sample indices, first > last if the ray misses
+        the valid convolution box
+        """
+        first, last = clip_many(self.pos_index_init[np.newaxis],
+        self.step_index[np.newaxis], context)
+        return int(first[0]), int(last[0])
 
     def go(self, idx_horizontal, idx_vertical, convolution, context):
         self.start(idx_horizontal, idx_vertical, convolution, context)
+        sample_first = self.sample_idx
         keepgoing = True
         while keepgoing:
             keepgoing = self.step(convolution, context)
+        stepped, saved = count_samples(sample_first, self.sample_idx,
+        self.sample_last, self.sample_far)
+        self.samples_stepped += stepped
+        self.samples_saved += saved
         return self.result
 
     def step(self, convolution, context):
@@ -64,59 +142,113 @@ class Ray():
         """
         keepgoing = True
         camera = context.camera
-        pos_view = self.pos_view_init + self.sample_idx * self.step_view
+        sample_idx = self.sample_idx
+        # past the valid box, nothing left to blend
+        if sample_idx > self.sample_last:
+            return False
+        pos_view_z = self.pos_view_init[2, 0] + sample_idx * self.step_view[2, 0]
         # stop when -p_n > fcv
-        if -pos_view[2] > camera.far_clip_view:
+        if -pos_view_z > camera.far_clip_view:
             return False # no need to keep going
         self.sample_idx += 1
 
-        # manually set last entry to 1 for matrix multiplication
-        pos_view[3] = 1
-        pos_world = camera.VtoW @ pos_view
-        convolution.evaluate(pos_world[0, 0], pos_world[1, 0], pos_world[2, 0], context)
+        pos_index = self.pos_index_init + sample_idx * self.step_index
+        if context.empty_space is not None and \
+        self.skip_transparent(sample_idx, pos_index, context):
+            return keepgoing
+        # value only, the gradient is computed below if the sample contributes
+        convolution.evaluate_index(pos_index[0], pos_index[1], pos_index[2], context,
+        gradient=False)
 
         if not convolution.inside:
             return keepgoing # skip this sample, proceed to the next
 
-        convo_grad_len = np.linalg.norm(convolution.gradient)
         # quantize the convo result to get the LUT lookup index
         transfer_func = context.transfer_func
         lut_idx = quantize(transfer_func.vmin, convolution.value,
         transfer_func.vmax, transfer_func.len)
 
-        rgba = transfer_func.rgba[:, lut_idx]
+        self.result_curr = self.shade(convolution, lut_idx, sample_idx, pos_view_z,
+        self.step_view_len, context)
+        keepgoing = self.blend(context)
+        return keepgoing
 
-        # clamp opacity to between 0 and 1
-        clamped = np.clip(rgba[3], 0, 1)
-        # opacity correction
-        # corrected = 1 - ((1 - clamped) ^ (delta / unit_step))
-        corrected = 1 - pow((1 - clamped), self.step_view_len / transfer_func.unit_step)
-        rgba[3] = np.clip(corrected, 0, 1)
+    def shade(self, convolution, lut_idx, sample_idx, pos_view_z, step_len, context):
+        """
+        classifies, lights and depth-cues the sample_idx-th sample, whose
+        opacity is corrected for a step of view-space length step_len
+        returns its rgba
+        """
+        camera = context.camera
+        rgba = self.classify(lut_idx, step_len, context)
 
         # no need to do Blinn-Phong if corrected opacity is 0
         # since color won't change
-        if corrected == 0:
+        if rgba[3] == 0:
             rgb_lit = rgba[:3] # no need to use opacity
         else:
-            if camera.ortho: # viewer direction is context.camera.n
-                viewer_dir = camera.n
-            else: # perspective
-                pos_world_dir = self.pos_world_init - pos_world
-                pos_world_dir /= np.linalg.norm(pos_world_dir) # normalize
-                viewer_dir = pos_world_dir
+            convolution.evaluate_gradient(context)
+            viewer_dir = self.viewer_direction(sample_idx, context)
             rgb_lit = self.blinn_phong(rgba[:3], convolution.gradient,
             viewer_dir, context)
 
         # depth cueing
-        gamma = lerp5(0, 1, camera.near_clip_view, -pos_view[2, 0], camera.far_clip_view)
+        gamma = lerp5(0, 1, camera.near_clip_view, -pos_view_z, camera.far_clip_view)
         dcn = context.params_light.depth_color_near
         dcf = context.params_light.depth_color_far
         color_lerped = lerp3(dcn, dcf, gamma)
         # multiply component-wise 3-vec of rgb and copy opacity over
-        self.result_curr = np.append(rgb_lit * color_lerped.squeeze(), rgba[3])
+        return np.append(rgb_lit * color_lerped.squeeze(), rgba[3])
 
-        keepgoing = self.blend(context)
-        return keepgoing
+    def classify(self, lut_idx, step_len, context):
+        """
+        returns the rgba of LUT entry lut_idx, with its opacity corrected
+        for a step of view-space length step_len
+        """
+        transfer_func = context.transfer_func
+        # copy, since the opacity is corrected in place below
+        rgba = transfer_func.rgba[:, lut_idx].copy()
+
+        # clamp opacity to between 0 and 1
+        clamped = np.clip(rgba[3], 0, 1)
+        # opacity correction
+        # corrected = 1 - ((1 - clamped) ^ (delta / unit_step))
+        corrected = 1 - pow((1 - clamped), step_len / transfer_func.unit_step)
+        rgba[3] = np.clip(corrected, 0, 1)
+        return rgba
+
+    def skip_transparent(self, sample_idx, pos_index, context):
+        """
+        skips the samples from sample_idx on that context.empty_space reports transparent
+        returns False if there is nothing to skip
+        blending zero-opacity samples leaves the result as it is, except that it
+        turns to zeros once two of them blend before any opacity accumulates
+        """
+        num = context.empty_space.skippable_samples(pos_index, self.step_index)
+        num = min(num, self.sample_far - sample_idx + 1)
+        if num < 1 or (num < 2 and self.result_cache is None):
+            return False
+        if self.result_cache is None or self.transparency == 1:
+            self.result = np.zeros(4, dtype=context.dtype)
+            self.transparency = 1
+            self.result_cache = self.result
+        self.sample_idx = sample_idx + num
+        return True
+
+    def viewer_direction(self, sample_idx, context):
+        """
+        unit vector from the sample_idx-th sample towards the viewer
+        """
+        camera = context.camera
+        if camera.ortho: # viewer direction is context.camera.n
+            return camera.n
+        # perspective
+        pos_view = self.pos_view_init + sample_idx * self.step_view
+        pos_view[3] = 1
+        pos_world = camera.VtoW @ pos_view
+        pos_world_dir = self.pos_world_init - pos_world
+        pos_world_dir /= np.linalg.norm(pos_world_dir) # normalize
+        return pos_world_dir
 
     def blend(self, context):
         """
@@ -136,14 +268,14 @@ class Ray():
             self.transparency *= transparency_curr
             opacity = 1 - self.transparency
             if opacity == 0: # avoid division by zero producing NaNs
-                self.result = np.zeros(4)
+                self.result = np.zeros(4, dtype=context.dtype)
             else:
                 self.result[:3] = 1 / opacity * rgb_composite
                 self.result[3] = opacity
-            # stop early if opacity > alpha_near_one
-            if opacity > context.transfer_func.alpha_near_one:
-                self.transparency = 0
-                keepgoing = False
+        # stop early once opacity reaches alpha_near_one, from the first sample on
+        if 1 - self.transparency >= context.transfer_func.alpha_near_one:
+            self.transparency = 0
+            keepgoing = False
         self.result_cache = self.result
         return keepgoing # True by default unless set otherwise
 
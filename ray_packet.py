@@ -0,0 +1,133 @@
+import numpy as np
+
+# my modules
+from ray import Ray, count_samples
+from shading import shade_many, blend_over_many
+
+class RayPacket():
+    """
+    marches a tile of rays together, holding their state as arrays with one
+    row per ray instead of one Ray object per pixel
+    every iteration takes one step of all active rays, with a single batched
+    convolution, classification and blend, and drops the rays that stopped
+    so the arrays only ever hold rays still marching
+    same samples and result as Ray.go, for scalar volumes with fixed steps
+    """
+    def __init__(self):
+        # totals over all rays marched, for reporting early ray termination
+        self.samples_stepped = 0 # from the first sample to where each ray stopped
+        self.samples_saved = 0 # left before the far clip or the volume exit
+        self.ray = Ray() # sets up each ray as Ray.start does
+
+    def start(self, idx_horizontal, idx_vertical, convolution, context):
+        """
+        rndRayStart for every pixel (idx_horizontal[i], idx_vertical[i])
+        """
+        num = len(idx_horizontal)
+        dtype = context.dtype
+        self.sample_idx = np.empty(num, dtype=int)
+        self.sample_last = np.empty(num, dtype=int)
+        self.sample_far = np.empty(num, dtype=int)
+        self.step_view_len = np.empty(num, dtype=dtype)
+        self.pos_view_init = np.empty((num, 3), dtype=dtype)
+        self.step_view = np.empty((num, 3), dtype=dtype)
+        self.pos_world_init = np.empty((num, 3), dtype=dtype)
+        self.pos_index_init = np.empty((num, 3), dtype=dtype)
+        self.step_index = np.empty((num, 3), dtype=dtype)
+        ray = self.ray
+        for i in range(num):
+            ray.start(idx_horizontal[i], idx_vertical[i], convolution, context)
+            self.sample_idx[i] = ray.sample_idx
+            self.sample_last[i] = ray.sample_last
+            self.sample_far[i] = ray.sample_far
+            self.step_view_len[i] = ray.step_view_len
+            self.pos_view_init[i] = ray.pos_view_init[:3, 0]
+            self.step_view[i] = ray.step_view[:3, 0]
+            self.pos_world_init[i] = ray.pos_world_init[:3, 0]
+            self.pos_index_init[i] = ray.pos_index_init
+            self.step_index[i] = ray.step_index
+
+        self.result = np.full((num, 4), context.outside_val, dtype=dtype)
+        # float64 like the scalar products in Ray.blend, whatever the precision
+        self.transparency = np.ones(num)
+        self.started = np.zeros(num, dtype=bool) # blended a first sample
+        self.active = np.arange(num) # rays still marching
+
+    def go(self, idx_horizontal, idx_vertical, convolution, context):
+        """
+        returns the (len(idx_horizontal), 4) RGBA results
+        """
+        self.start(idx_horizontal, idx_vertical, convolution, context)
+        sample_first = self.sample_idx.copy()
+        keepgoing = True
+        while keepgoing:
+            keepgoing = self.step(convolution, context)
+        stepped, saved = count_samples(sample_first, self.sample_idx,
+        self.sample_last, self.sample_far)
+        self.samples_stepped += stepped
+        self.samples_saved += saved
+        return self.result
+
+    def step(self, convolution, context):
+        """
+        rndProbeRgbaLit for all active rays
+        returns a boolean, keepgoing, False once no ray is active
+        """
+        camera = context.camera
+        active = self.active
+        sample_idx = self.sample_idx[active]
+        pos_view_z = self.pos_view_init[active, 2] + sample_idx * self.step_view[active, 2]
+        # past the valid box, or -p_n > fcv
+        marching = (sample_idx <= self.sample_last[active]) & \
+        (-pos_view_z <= camera.far_clip_view)
+        active, sample_idx, pos_view_z = \
+        active[marching], sample_idx[marching], pos_view_z[marching]
+        self.active = active
+        if len(active) == 0:
+            return False # no need to keep going
+        self.sample_idx[active] += 1
+
+        pos_index = self.pos_index_init[active] + \
+        sample_idx[:, np.newaxis] * self.step_index[active]
+        # values only, the gradients are computed for the contributing samples
+        values, _, inside = convolution.evaluate_many_index(pos_index, context,
+        gradient=False)
+        # samples outside the volume are skipped, those rays proceed to the next
+        idx = active[inside]
+        sample_idx, pos_index = sample_idx[inside], pos_index[inside]
+
+        # both only for the samples with non-zero opacity, as in Ray.shade
+        def gradient_func(mask):
+            _, gradients, _ = convolution.evaluate_many_index(pos_index[mask], context)
+            return gradients
+
+        def viewer_func(mask):
+            return self.viewer_directions(idx[mask], sample_idx[mask], context)
+
+        rgba = shade_many(values[inside], self.step_view_len[idx], pos_view_z[inside],
+        gradient_func, viewer_func, context)
+        keepgoing = blend_over_many(self.result, self.transparency, self.started,
+        rgba, idx, context.transfer_func.alpha_near_one)
+        # drop the rays that reached alpha_near_one
+        self.active = np.setdiff1d(active, idx[~keepgoing], assume_unique=True)
+        return len(self.active) > 0
+
+    def viewer_directions(self, idx, sample_idx, context):
+        """
+        (len(idx), 3) unit vectors from the sample_idx-th samples of rays idx
+        towards the viewer, as in Ray.viewer_direction
+        NaN for the first sample of a perspective ray, which is the viewer
+        position, so blinn_phong_many gives it no specular term
+        """
+        camera = context.camera
+        if camera.ortho: # viewer direction is context.camera.n
+            return camera.n.squeeze()
+        # perspective
+        pos_view = self.pos_view_init[idx] + sample_idx[:, np.newaxis] * self.step_view[idx]
+        pos_world = pos_view @ camera.VtoW[:3, :3].T + camera.VtoW[:3, 3]
+        pos_world_dir = self.pos_world_init[idx] - pos_world
+        length = np.linalg.norm(pos_world_dir, axis=1, keepdims=True)
+        viewer_dirs = np.full_like(pos_world_dir, np.nan)
+        away = length[:, 0] > 0
+        viewer_dirs[away] = pos_world_dir[away] / length[away]
+        return viewer_dirs
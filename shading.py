@@ -0,0 +1,132 @@
+# vectorized versions of the per-sample work in Ray.step and Ray.blend
+# samples are along the first axis
+import numpy as np
+
+# my modules
+from utils import lerp3, lerp5, quantize_many
+
+def classify_many(values, step_len, transfer_func):
+    """
+    LUT lookup and opacity correction
+    step_len: scalar or (N,) view-space lengths of the steps
+    returns (N, 4) rgba with corrected opacity
+    """
+    lut_idx = quantize_many(transfer_func.vmin, values,
+    transfer_func.vmax, transfer_func.len)
+    rgba = transfer_func.rgba[:, lut_idx].T # fancy indexing copies
+    clamped = np.clip(rgba[:, 3], 0, 1)
+    corrected = 1 - pow(1 - clamped, step_len / transfer_func.unit_step)
+    rgba[:, 3] = np.clip(corrected, 0, 1)
+    return rgba
+
+def blinn_phong_many(rgb_in, gradients, viewer_dirs, context):
+    """
+    rgb_in, gradients: (N, 3), gradients in world space
+    viewer_dirs: (N, 3) or a single 3-vector shared by all samples
+    returns (N, 3) rgb values
+    """
+    light = context.light
+    params_light = context.params_light
+    rgb_out = params_light.k_ambient * rgb_in
+    if light.num == 0 or \
+    (params_light.k_ambient == 0 and params_light.k_specular == 0):
+        return rgb_out # done
+    gradient_len = np.linalg.norm(gradients, axis=1)
+    lit = gradient_len != 0
+    if not lit.any():
+        return rgb_out # done
+
+    # surface normal N = -g/|g|
+    normal = -gradients[lit] / gradient_len[lit, np.newaxis]
+    viewer_dirs = np.asarray(viewer_dirs)
+    if viewer_dirs.ndim == 2:
+        viewer_dirs = viewer_dirs[lit]
+    rgb_lit = rgb_in[lit]
+    for i in range(light.num):
+        light_col = light.rgb[i]
+        light_dir = light.xyz[i]
+        # compute diffuse
+        scale = normal @ light_dir
+        # NaN compares False, like max(0, nan) in Ray.blinn_phong
+        scale = np.where(scale > 0, scale, 0)
+        diffuse = params_light.k_diffuse * scale[:, np.newaxis] * (rgb_lit * light_col)
+
+        # compute specular
+        halfway = viewer_dirs + light_dir
+        halfway = halfway / np.linalg.norm(halfway, axis=-1, keepdims=True)
+        scale = np.sum(normal * halfway, axis=1)
+        scale = np.where(scale > 0, scale, 0) ** params_light.p_shininess
+        specular = params_light.k_specular * scale[:, np.newaxis] * light_col
+
+        rgb_out[lit] += diffuse + specular
+    return rgb_out
+
+def depth_cue_many(pos_view_z, context):
+    """
+    pos_view_z: scalar or (N,) view-space z of the samples
+    returns (N, 3) or (1, 3) colors to multiply the lit rgb with
+    """
+    camera = context.camera
+    gamma = lerp5(0, 1, camera.near_clip_view, -np.asarray(pos_view_z), camera.far_clip_view)
+    dcn = context.params_light.depth_color_near
+    dcf = context.params_light.depth_color_far
+    return lerp3(dcn, dcf, np.reshape(gamma, (-1, 1)))
+
+def shade_many(values, step_len, pos_view_z, gradient_func, viewer_dirs, context):
+    """
+    everything Ray.step does after the convolution
+    gradient_func(mask) returns the (mask.sum(), 3) world-space gradients of the
+    masked samples, it is only called for samples with non-zero opacity
+    viewer_dirs: as in blinn_phong_many, or a function of the same mask
+    returning them for the masked samples only
+    returns (N, 4) samples ready for blend_over_many
+    """
+    rgba = classify_many(values, step_len, context.transfer_func)
+    rgb = rgba[:, :3]
+    contributes = rgba[:, 3] != 0
+    if contributes.any():
+        if callable(viewer_dirs):
+            viewer_dirs = viewer_dirs(contributes)
+        else:
+            viewer_dirs = np.asarray(viewer_dirs)
+            if viewer_dirs.ndim == 2:
+                viewer_dirs = viewer_dirs[contributes]
+        rgb[contributes] = blinn_phong_many(rgb[contributes],
+        gradient_func(contributes), viewer_dirs, context)
+    rgb *= depth_cue_many(pos_view_z, context)
+    return rgba
+
+def blend_over_many(result, transparency, started, rgba, idx, alpha_near_one):
+    """
+    rndBlendOver for one sample of each ray in idx, with no repeated rays
+    result (R, 4), transparency (R,), started (R,) hold the state of all rays
+    and are updated in place, rgba (len(idx), 4) are the new samples
+    returns a (len(idx),) boolean array, keepgoing
+    """
+    keepgoing = np.ones(len(idx), dtype=bool)
+    first = ~started[idx]
+    # first step of the ray
+    first_idx = idx[first]
+    result[first_idx] = rgba[first]
+    transparency[first_idx] = 1 - rgba[first, 3]
+    started[first_idx] = True
+
+    rest = ~first
+    rest_idx = idx[rest]
+    curr = rgba[rest]
+    prev = result[rest_idx]
+    rgb_premultiplied = prev[:, 3:] * prev[:, :3]
+    rgb_curr = transparency[rest_idx, np.newaxis] * curr[:, 3:] * curr[:, :3]
+    rgb_composite = rgb_premultiplied + rgb_curr
+    transparency[rest_idx] *= 1 - curr[:, 3]
+    opacity = 1 - transparency[rest_idx]
+    blended = np.zeros_like(prev) # avoid division by zero producing NaNs
+    nonzero = opacity != 0
+    blended[nonzero, :3] = 1 / opacity[nonzero, np.newaxis] * rgb_composite[nonzero]
+    blended[nonzero, 3] = opacity[nonzero]
+    result[rest_idx] = blended
+    # stop early once opacity reaches alpha_near_one, from the first sample on
+    stop = 1 - transparency[idx] >= alpha_near_one
+    transparency[idx[stop]] = 0
+    keepgoing[stop] = False
+    return keepgoing
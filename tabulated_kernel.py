@@ -0,0 +1,57 @@
+import numpy as np
+
+class TabulatedKernel():
+    """
+    wraps a kernel with lookup tables of its values and derivatives
+    sampled at resolution points per unit of index space
+    lookups linearly interpolate between table entries
+    """
+    def __init__(self, kernel, resolution=256):
+        self.kernel = kernel
+        self.name = '{}:tab{}'.format(kernel.name, resolution)
+        self.support = kernel.support
+        self.resolution = resolution
+
+        support = kernel.support
+        if support & 1: # odd support
+            idx_start = (1 - support) // 2
+        else:
+            idx_start = 1 - support // 2
+        self.offsets = np.arange(idx_start, idx_start + support)
+
+        half = kernel.support / 2
+        num = int(np.ceil(kernel.support * resolution)) + 1
+        self.xs = np.linspace(-half, half, num)
+        self.table = kernel.apply(self.xs)
+        self.table_derivative = kernel.apply_derivative(self.xs)
+
+        # compare against the exact kernel between the table entries
+        check = np.linspace(-half, half, 8 * (num - 1) + 1)
+        self.max_error = np.max(np.fabs(self.apply(check) - kernel.apply(check)))
+        self.max_error_derivative = np.max(np.fabs(
+            self.apply_derivative(check) - kernel.apply_derivative(check)))
+
+    def evaluate(self, xx):
+        return float(np.interp(xx, self.xs, self.table))
+
+    def apply(self, xs):
+        """
+        vectorized version of evaluate, xs is a vector
+        """
+        return np.interp(xs, self.xs, self.table)
+
+    def evaluate_derivative(self, xx):
+        return float(np.interp(xx, self.xs, self.table_derivative))
+
+    def apply_derivative(self, xs):
+        return np.interp(xs, self.xs, self.table_derivative)
+
+    def weights(self, alphas):
+        """
+        weights and derivatives at all support points in one call
+        returns (weights, derivatives), each of shape alphas.shape + (support,)
+        """
+        alphas = np.asarray(alphas)
+        xs = alphas[..., np.newaxis] - self.offsets
+        dtype = alphas.dtype
+        return self.apply(xs).astype(dtype), self.apply_derivative(xs).astype(dtype)
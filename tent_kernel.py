@@ -0,0 +1,53 @@
+# kernel.c
+import numpy as np
+
+class TentKernel():
+    """
+    linear interpolation, support 2
+    """
+    def __init__(self):
+        self.name = 'tent'
+        self.support = 2
+
+    def evaluate(self, xx):
+        x = np.fabs(xx)
+        if x < 1:
+            return 1 - x
+        return 0
+
+    def apply(self, xs):
+        """
+        vectorized version of evaluate, xs is a vector
+        """
+        x = np.fabs(xs)
+        return np.where(x < 1, 1 - x, 0.0)
+
+    def evaluate_derivative(self, xx):
+        """
+        derivative of tent kernel, taken from the right at the kinks
+        so that the derivative weights always sum to 0
+        """
+        if -1 <= xx < 0:
+            return 1
+        elif 0 <= xx < 1:
+            return -1
+        return 0
+
+    def apply_derivative(self, xs):
+        ret = np.zeros(xs.shape)
+        ret = np.where((xs >= -1) & (xs < 0), 1.0, ret)
+        ret = np.where((xs >= 0) & (xs < 1), -1.0, ret)
+        return ret
+
+    def weights(self, alphas):
+        """
+        weights and derivatives at all support points in one call
+        alphas: floating-point array of fractional offsets in [0, 1), any shape
+        the results have the same dtype as alphas
+        returns (weights, derivatives), each of shape alphas.shape + (2,)
+        entry i holds apply(alpha - i) resp. apply_derivative(alpha - i)
+        """
+        t = np.asarray(alphas)
+        weights = np.stack([1 - t, t], axis=-1)
+        derivatives = np.stack([-np.ones_like(t), np.ones_like(t)], axis=-1)
+        return weights, derivatives
@@ -5,8 +5,27 @@ import numpy as np
 import nrrd
 
 # my modules
+from tent_kernel import TentKernel
+from catmull_rom_kernel import CatmullRomKernel
 from cubic_bspline_kernel import CubicBsplineKernel
+from quintic_bspline_kernel import QuinticBsplineKernel
+from tabulated_kernel import TabulatedKernel
 from camera import Camera
+from macrocell_grid import MacrocellGrid, sliding_min_max, opaque_before
+from distance_field import distance_field
+from occupancy_octree import OccupancyOctree
+from preintegration_table import preintegration_table
+from convolution import Convolution
+from prefiltered_sampler import PrefilteredSampler, prefilter_volume, \
+central_difference_volume, dequantize_volume
+
+# kernels selectable by name, following the rrendr -k names
+kernel_registry = {
+    'tent': TentKernel,
+    'ctmr': CatmullRomKernel,
+    'bspln3': CubicBsplineKernel,
+    'bspln5': QuinticBsplineKernel,
+}
 
 def unlerp(imin, xx, imax):
     """
@@ -39,6 +58,15 @@ def quantize(vmin, val, vmax, num):
         idx -= 1
     return int(idx)
 
+def quantize_many(vmin, vals, vmax, num):
+    """
+    vectorized version of quantize, returns an int array
+    """
+    step = (vmax - vmin) / num
+    idx = np.floor((vals - vmin) / step)
+    # covers val <= vmin, val >= vmax and idx == num
+    return np.clip(idx, 0, num - 1).astype(int)
+
 def construct_context(params_dict):
     """
     probe: rndProbeRgbaLit
@@ -46,21 +74,72 @@ def construct_context(params_dict):
     no levoy
     """
     context = SimpleNamespace()
+    # np.float64 or np.float32, for the volume, LUT, matrices and results
+    context.dtype = np.dtype(params_dict.get('precision', 'float64')).type
     context.volume = load_volume(params_dict['fpath_volume'])
-    context.kernel = CubicBsplineKernel()
+    data = context.volume.data
+    # only ever narrow, a float32 volume stays float32 in float64 mode
+    if np.issubdtype(data.dtype, np.floating) and \
+    data.dtype.itemsize > np.dtype(context.dtype).itemsize:
+        context.volume.data = data.astype(context.dtype)
+    if np.issubdtype(data.dtype, np.integer):
+        # kept in its native dtype, converted per gathered neighborhood
+        context.volume.scale = params_dict.get('volume_scale', 1)
+        context.volume.offset = params_dict.get('volume_offset', 0)
+    elif params_dict.get('quantize_bits'): # 0 or unspecified keeps the floats
+        quantize_volume(context.volume, params_dict['quantize_bits'],
+        params_dict.get('brick_size', 16))
+    context.kernel = kernel_registry[params_dict.get('kernel', 'bspln3')]()
+    if params_dict.get('kernel_table_res'): # 0 or unspecified for exact kernel
+        context.kernel = TabulatedKernel(context.kernel, params_dict['kernel_table_res'])
 
     context.plane_sep = params_dict['plane_sep']
+    # (min, max) step in multiples of plane_sep for AdaptiveRay, None for fixed steps
+    context.adaptive_steps = params_dict.get('adaptive_steps')
+    if context.adaptive_steps is not None:
+        step_min, step_max = context.adaptive_steps
+        if not 0 < step_min <= step_max:
+            raise ValueError('adaptive steps need 0 < min <= max, got {} {}'.format(
+            step_min, step_max))
     context.num_threads = params_dict['num_threads']
     context.outside_val = params_dict['outside_val']
+    context.block_cache_size = params_dict.get('block_cache_size', 0)
 
-    context.camera = Camera(**params_dict['params_camera'])
+    context.camera = Camera(**params_dict['params_camera'], dtype=context.dtype)
 
-    context.transfer_func = load_transfer_func(params_dict['fpath_lut'])
-    context.transfer_func.unit_step = params_dict['unit_step']
-    context.transfer_func.alpha_near_one = params_dict['alpha_near_one']
+    # one transfer function per channel, a single one is shared by all channels
+    fpaths_lut = params_dict['fpath_lut']
+    if isinstance(fpaths_lut, str):
+        fpaths_lut = [fpaths_lut]
+    num_channels = context.volume.num_channels or 1
+    if len(fpaths_lut) == 1:
+        fpaths_lut = fpaths_lut * num_channels
+    if len(fpaths_lut) != num_channels:
+        raise ValueError('got {} transfer functions for {} channels'.format(
+        len(fpaths_lut), num_channels))
+    context.transfer_funcs = []
+    for fpath_lut in fpaths_lut:
+        transfer_func = load_transfer_func(fpath_lut)
+        transfer_func.rgba = transfer_func.rgba.astype(context.dtype)
+        transfer_func.unit_step = params_dict['unit_step']
+        transfer_func.alpha_near_one = params_dict['alpha_near_one']
+        context.transfer_funcs.append(transfer_func)
+    context.transfer_func = context.transfer_funcs[0]
+    if context.adaptive_steps is not None:
+        index_opacity(context.transfer_func)
+    # segment classification for PreintegratedRay, None to point-sample the LUT
+    context.preintegrated = None
+    if params_dict.get('preintegrate', False):
+        context.preintegrated = preintegration_table(context.transfer_func)
 
     context.light = load_light(params_dict['fpath_light'])
+    context.light.rgb = context.light.rgb.astype(context.dtype)
+    context.light.xyz = context.light.xyz.astype(context.dtype)
     context.params_light = construct_params_light()
+    context.params_light.depth_color_near = \
+    context.params_light.depth_color_near.astype(context.dtype)
+    context.params_light.depth_color_far = \
+    context.params_light.depth_color_far.astype(context.dtype)
 
     support = context.kernel.support
     if support & 1: # odd support
@@ -73,27 +152,198 @@ def construct_context(params_dict):
     context.idx_start = int(idx_start)
     context.idx_end = int(idx_end)
 
-    context.WtoI = np.linalg.inv(context.volume.ItoW)
+    # box of base indices (xn, yn, zn) whose kernel support lies in the volume
+    # inclusive on both ends
+    context.valid_lo = np.full(3, -context.idx_start)
+    context.valid_hi = np.array(context.volume.data.shape[-3:]) - 1 - context.idx_end
+    if params_dict.get('pad_volume', False):
+        pad_volume(context.volume, support)
+    context.uniform = None
+    if params_dict.get('uniform_skip', False):
+        context.uniform = uniform_support_map(context.volume,
+        context.idx_start, context.idx_end)
+
+    # invert in float64, then store in the working precision
+    WtoI = np.linalg.inv(context.volume.ItoW)
+    context.WtoI = WtoI.astype(context.dtype)
     # take upper 3x3 block of 4x4 matrix, take inverse then transpose
     mat = context.volume.ItoW[:3, :3]
-    context.gradient_ItoW = np.linalg.inv(mat).T
+    context.gradient_ItoW = np.linalg.inv(mat).T.astype(context.dtype)
+    # fused view-to-index transform for marching rays in index space
+    context.VtoI = (WtoI @ context.camera.VtoW).astype(context.dtype)
+
+    if context.volume.num_channels is not None and (context.uniform is not None or \
+    params_dict.get('macrocell_size') or params_dict.get('adaptive_steps') or \
+    params_dict.get('preintegrate', False) or \
+    params_dict.get('gradient_method', 'kernel') != 'kernel' or \
+    params_dict.get('sampler', 'convo') != 'convo'):
+        raise ValueError('multi-channel volumes support only the convolution sampler '
+        'with kernel gradients, fixed steps, a point-sampled LUT and no uniform-support '
+        'or macrocell skipping')
+    # tile side in pixels for RayPacket, 0 to march one Ray per pixel
+    context.packet_size = params_dict.get('packet_size', 0)
+    if context.packet_size and (context.volume.num_channels is not None or \
+    params_dict.get('macrocell_size') or params_dict.get('adaptive_steps') or \
+    params_dict.get('preintegrate', False)):
+        raise ValueError('ray packets support only scalar volumes with fixed steps, '
+        'a point-sampled LUT and no macrocell skipping')
+
+    # empty-space skipping over bricks the transfer function makes transparent
+    # Ray skips with context.empty_space, the macrocells themselves, a
+    # distance field or an occupancy octree over them
+    context.macrocells = None
+    context.empty_space = None
+    if params_dict.get('macrocell_size'): # 0 or unspecified to disable
+        context.macrocells = MacrocellGrid(context.volume, context.kernel,
+        params_dict['macrocell_size'], context.valid_lo, context.valid_hi)
+        context.macrocells.classify(context.transfer_func)
+        context.empty_space = context.macrocells
+        if params_dict.get('distance_field', False):
+            context.empty_space = distance_field(context.macrocells,
+            context.volume, context.kernel, context.transfer_func)
+        elif params_dict.get('octree', False):
+            context.empty_space = OccupancyOctree(context.macrocells)
+            context.empty_space.classify(context.transfer_func)
+
+    # kernel: derivative of the reconstruction kernel
+    # cdiff: trilinear interpolation of central differences, for drafts
+    context.gradient_method = params_dict.get('gradient_method', 'kernel')
+    context.sampler = params_dict.get('sampler', 'convo')
+    # PrefilteredSampler interpolates the gradients prefiltered with the kernel
+    if context.sampler == 'prefilt' and context.gradient_method != 'kernel':
+        raise ValueError('the prefiltered sampler supports only kernel gradients, '
+        'got {}'.format(context.gradient_method))
+    if context.gradient_method == 'cdiff':
+        context.gradient_volume = central_difference_volume(context.volume, context.dtype)
+
+    if context.sampler == 'prefilt':
+        context.prefiltered = prefilter_volume(context.volume, context.kernel)
 
     return context
 
+def construct_sampler(context):
+    """
+    one per worker, either a Convolution or a PrefilteredSampler
+    """
+    if context.sampler == 'prefilt':
+        return PrefilteredSampler()
+    return Convolution(context.block_cache_size)
+
 def load_volume(fpath_volume):
+    """
+    scalar volumes are indexed data[x, y, z]
+    multi-channel volumes have a leading non-spatial axis, data[c, x, y, z],
+    and volume.num_channels set, it is None for scalar volumes
+    """
     data, header = nrrd.read(fpath_volume)
-    mat = np.append(header['space directions'], header['space origin'][:, np.newaxis], axis=1)
+    # non-spatial axes have no space direction (a row of NaN or None)
+    directions = [row for row in header['space directions']
+    if row is not None and np.all(np.isfinite(np.asarray(row, dtype=float)))]
+    directions = np.array(directions, dtype=float)
+    mat = np.append(directions, header['space origin'][:, np.newaxis], axis=1)
     ItoW = np.append(mat, [[0, 0, 0, 1]], axis=0)
-    volume = SimpleNamespace(data=data, ItoW=ItoW)
+    num_channels = data.shape[0] if data.ndim == 4 else None
+    # value = data * scale + offset for integer volumes, None for float ones
+    # scale and offset are per-brick arrays if brick_size is set
+    volume = SimpleNamespace(data=data, ItoW=ItoW, fpath=fpath_volume,
+    scale=None, offset=None, brick_size=None, num_channels=num_channels)
     return volume
 
+def quantize_volume(volume, bits, brick_size):
+    """
+    lossy quantization of a float volume to uint8 or uint16 with a scale and
+    offset per brick of brick_size^3 voxels, shared by all channels
+    stores the max and rms absolute reconstruction error in volume.quantize_error
+    """
+    dtype = {8: np.uint8, 16: np.uint16}[bits]
+    levels = np.iinfo(dtype).max
+    data = volume.data
+    shape = data.shape[-3:]
+    starts = [np.arange(0, n, brick_size) for n in shape]
+    # per-brick min and max, reduced over the channels too
+    lo, hi = data, data
+    for axis in range(3):
+        lo = np.minimum.reduceat(lo, starts[axis], axis=axis - 3)
+        hi = np.maximum.reduceat(hi, starts[axis], axis=axis - 3)
+    if data.ndim == 4:
+        lo, hi = lo.min(axis=0), hi.max(axis=0)
+    lo, hi = lo.astype(float), hi.astype(float)
+    # constant bricks store zeros and reconstruct exactly from the offset
+    scale = np.where(hi > lo, (hi - lo) / levels, 1)
+
+    quantized = np.empty(data.shape, dtype=dtype)
+    max_error = 0
+    sum_sq_error = 0
+    # one slab of bricks along x at a time, to bound the float64 temporaries
+    for i, x0 in enumerate(starts[0]):
+        slab = data[..., x0:x0 + brick_size, :, :].astype(float)
+        crop = slab.shape[-3:]
+        scale_slab = np.repeat(np.repeat(scale[i], brick_size, axis=0),
+        brick_size, axis=1)[np.newaxis, :crop[1], :crop[2]]
+        offset_slab = np.repeat(np.repeat(lo[i], brick_size, axis=0),
+        brick_size, axis=1)[np.newaxis, :crop[1], :crop[2]]
+        stored = np.clip(np.rint((slab - offset_slab) / scale_slab), 0, levels)
+        quantized[..., x0:x0 + brick_size, :, :] = stored
+        error = np.abs(stored * scale_slab + offset_slab - slab)
+        max_error = max(max_error, error.max())
+        sum_sq_error += np.sum(error ** 2)
+
+    volume.data = quantized
+    volume.scale = scale
+    volume.offset = lo
+    volume.brick_size = brick_size
+    volume.quantize_error = (max_error, np.sqrt(sum_sq_error / data.size))
+
+def pad_volume(volume, pad):
+    """
+    add a padded copy of volume.data with pad ghost cells on every side
+    volume.padded[i + pad] == volume.data[i], ghost cells replicate the edge
+    """
+    volume.pad = pad
+    # only the three spatial axes are padded
+    pad_width = [(0, 0)] * (volume.data.ndim - 3) + [(pad, pad)] * 3
+    volume.padded = np.pad(volume.data, pad_width, mode='edge')
+
+def uniform_support_map(volume, idx_start, idx_end):
+    """
+    boolean map over the base indices of the valid convolution box
+    entry [i, j, k] is True if every voxel in the kernel support of base index
+    valid_lo + (i, j, k) has the same value
+    """
+    support = idx_end - idx_start + 1
+    # compare the values, stored integers are only comparable within a brick
+    data = volume.data if volume.brick_size is None else dequantize_volume(volume)
+    lo, hi = sliding_min_max(data, support)
+    return lo == hi
+
 def load_transfer_func(fpath_lut):
     data, header = nrrd.read(fpath_lut)
     vmin = header['axis mins'][1]
     vmax = header['axis maxs'][1]
-    transfer_func = SimpleNamespace(rgba=data, vmin=vmin, vmax=vmax, len=data.shape[1])
+    transfer_func = SimpleNamespace(rgba=data, vmin=vmin, vmax=vmax, len=data.shape[1],
+    fpath=fpath_lut)
     return transfer_func
 
+def index_opacity(transfer_func):
+    """
+    lookups of where the LUT is opaque, for AdaptiveRay
+    opaque_before[i]: number of opaque entries before index i, len + 1 of them
+    opaque_above[i]: lowest value of an opaque entry at or above index i
+    opaque_below[i]: highest value of an opaque entry at or below index i
+    with inf and -inf where there is none
+    """
+    num = transfer_func.len
+    opaque = transfer_func.rgba[3] > 0
+    idx = np.arange(num)
+    # value at the lower edge of every entry, and of one past the last
+    edges = np.append(lerp5(transfer_func.vmin, transfer_func.vmax, 0, idx, num), np.inf)
+    transfer_func.opaque_before = opaque_before(transfer_func)
+    above = np.minimum.accumulate(np.where(opaque, idx, num)[::-1])[::-1]
+    transfer_func.opaque_above = edges[above]
+    below = np.maximum.accumulate(np.where(opaque, idx, -1))
+    transfer_func.opaque_below = np.where(below >= 0, edges[below + 1], -np.inf)
+    transfer_func.opaque_below[below == num - 1] = transfer_func.vmax
+
 def load_light(fpath_light):
     """
     assume rgb, normalized world-space light directions